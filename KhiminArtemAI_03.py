@@ -1,12 +1,17 @@
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from dotenv import load_dotenv
 import os
 import io
-import shutil
 import hashlib
+import secrets
+import struct
+import time
 import asyncio
-from typing import Dict, List, Optional, Tuple
+import numpy as np
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
 # from TerraYolo.TerraYolo import TerraYoloV5   # фреймворк TerraYolo
 
 import sys  # импортируем sys для добавления локальной папки yolov5 в пути Python
@@ -16,38 +21,58 @@ from telegram import BotCommand, BotCommandScopeAllPrivateChats, BotCommandScope
 
 
 import logging  # логирование для стабильной диагностики
-from logging.handlers import RotatingFileHandler  # ротация логов, чтобы файл не рос бесконечно
-from telegram.error import NetworkError, TimedOut, RetryAfter  # типовые ошибки сети Telegram
+from logging_setup import add_stage, request_stages, setup_logging, start_request  # логи вне event loop
+from telegram.error import BadRequest, NetworkError, TimedOut, RetryAfter  # типовые ошибки сети Telegram
 
 
 # === 0) ENV / TOKEN / YOLO ===================================================
 load_dotenv()
 TOKEN = os.environ.get("TOKEN")  # ВАЖНО !!!!!  токен бота
 
+# --- Режим получения обновлений ----------------------------------------------
+BOT_MODE = os.environ.get("BOT_MODE", "polling")  # "polling" | "webhook"
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # внешний https-адрес бота (для setWebhook); пусто — не вызываем
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")  # где слушает локальный сервер
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # проверка X-Telegram-Bot-Api-Secret-Token
+if not WEBHOOK_SECRET and WEBHOOK_URL:
+    WEBHOOK_SECRET = secrets.token_urlsafe(32)  # бот сам передаст его в setWebhook — годится случайный
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL")  # свой Bot API сервер / локальный фейк для тестов
+
+# --- Метрики Prometheus (/metrics) -------------------------------------------
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))  # 0 — не поднимать; в webhook-режиме /metrics на его порту
+
 
 # --- 0.1) LOGGING -------------------------------------------------------------  # раздел логирования
 logger = logging.getLogger(__name__)  # создаём логгер текущего модуля
 
-logging.basicConfig(  # базовая настройка логирования
-    level=logging.INFO,  # уровень логирования INFO
-    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",  # единый формат логов
-)  # конец basicConfig
+LOG_FILE = os.environ.get("LOG_FILE", "model.log")  # файл лога (ротация: 2 МБ × 5 файлов)
+LOG_JSON = True                  # в файл — JSON-строки (request_id, стадии запроса); в консоль — прежний текст
+LOG_SAMPLE_EVERY = {             # рутинные строки шумных логгеров: пишем 1 из N (WARNING и выше — все)
+    "httpx": 100,                # каждый запрос к Bot API, в т.ч. getUpdates раз в 10 с
+    "telegram.ext": 10,
+}
 
-file_handler = RotatingFileHandler(  # файл-обработчик с ротацией
-    filename="model.log",  # пишем логи в model.log (как у тебя уже есть файл)
-    maxBytes=2 * 1024 * 1024,  # максимум 2 МБ на файл лога
-    backupCount=5,  # хранить до 5 резервных файлов
-    encoding="utf-8",  # кодировка UTF-8
-)  # конец RotatingFileHandler
+log_listener = None  # поток записи логов: поднимает init_logging() при старте бота, а не при импорте
 
-file_handler.setFormatter(  # задаём форматирование логов для файла
-    logging.Formatter("%(asctime)s | %(levelname)s | %(name)s | %(message)s")  # формат логов
-)  # конец setFormatter
 
-logging.getLogger().addHandler(file_handler)  # добавляем запись логов в файл для root-логгера
+def init_logging() -> None:
+    global log_listener
+    if log_listener is not None:
+        return
+    log_listener = setup_logging(  # файл и консоль пишет отдельный поток — event loop не ждёт диск
+        log_file=LOG_FILE,
+        level=logging.INFO,
+        max_bytes=2 * 1024 * 1024,  # максимум 2 МБ на файл лога
+        backup_count=5,  # хранить до 5 резервных файлов
+        json_file=LOG_JSON,
+        sample_every=LOG_SAMPLE_EVERY,
+        secret_values=(TOKEN, WEBHOOK_SECRET),  # токен и секрет вебхука не попадают в логи
+    )
 
-logging.getLogger("httpx").setLevel(logging.WARNING)  # отключаем информационный шум httpx
-logging.getLogger("httpcore").setLevel(logging.WARNING)  # отключаем информационный шум httpcore
+logging.getLogger("httpcore").setLevel(logging.WARNING)  # отключаем отладочный шум httpcore
 
 # --- 0.2) Подключение локальной папки yolov5 ---------------------------------  # раздел подключения локального YOLOv5
 CURRENT_DIR = Path(__file__).resolve().parent  # получаем абсолютный путь к папке текущего файла
@@ -56,83 +81,63 @@ YOLOV5_DIR = CURRENT_DIR / "yolov5"  # формируем путь к локал
 if str(YOLOV5_DIR) not in sys.path:  # если путь к yolov5 ещё не добавлен в sys.path
     sys.path.insert(0, str(YOLOV5_DIR))  # добавляем путь в начало sys.path для корректного импорта модулей yolov5
 
-# from detect import run as yolov5_detect_run  # импортируем функцию run из локального yolov5/detect.py
-
-
-class TerraYoloV5:
-    """Локальный адаптер вместо внешнего TerraYoloV5 для совместимости с текущей логикой проекта."""  # описание класса
-
-    def __init__(self, work_dir: str) -> None:
-        self.work_dir = work_dir  # сохраняем рабочую директорию проекта
-
-    def run(self, test_dict: dict, mode: str = "test") -> None:
-        """Запускает локальный yolov5/detect.py через совместимый интерфейс test_dict."""  # описание метода
-        weights = test_dict.get("weights", "yolov5x.pt")  # получаем путь к весам модели
-        source = test_dict.get("source")  # получаем путь к источнику изображений
-        name = test_dict.get("name", "exp")  # получаем имя папки результата
-        conf_thres = float(test_dict.get("conf-thres", 0.25))  # получаем confidence threshold
-        iou_thres = float(test_dict.get("iou-thres", 0.45))  # получаем IoU threshold
-        classes_raw = test_dict.get("classes")  # получаем строку или список классов
-
-        if classes_raw is None:  # если классы не указаны
-            classes = None  # передаём None, чтобы детектить все классы
-        elif isinstance(classes_raw, str):  # если классы пришли строкой вида "0 1 2"
-            classes = [int(item) for item in classes_raw.split() if item.strip()]  # преобразуем строку в список целых индексов
-        elif isinstance(classes_raw, (list, tuple, set)):  # если классы уже в виде коллекции
-            classes = [int(item) for item in classes_raw]  # приводим все значения к int
-        else:  # если тип неожиданный
-            classes = None  # безопасно сбрасываем фильтр классов
-
-        weights_path = Path(self.work_dir) / weights  # формируем абсолютный путь к весам модели внутри проекта
-        project_path = Path(self.work_dir) / "yolov5" / "runs" / "detect"  # формируем путь к папке результатов detect
-
-        logger.info(  # пишем в лог факт запуска YOLOv5
-            "Запуск локального yolov5: weights=%s, source=%s, name=%s, conf=%.3f, iou=%.3f, classes=%s",
-            weights_path,
-            source,
-            name,
-            conf_thres,
-            iou_thres,
-            classes,
-        )  # конец logger.info
-
-        yolov5_detect_run(  # запускаем локальный детект напрямую через функцию run из detect.py
-            weights=str(weights_path),  # передаём путь к весам модели
-            source=str(source),  # передаём путь к папке с изображениями
-            data=str(YOLOV5_DIR / "data" / "coco128.yaml"),  # передаём yaml с описанием датасета COCO
-            imgsz=(640, 640),  # задаём размер изображения для инференса
-            conf_thres=conf_thres,  # передаём confidence threshold
-            iou_thres=iou_thres,  # передаём IoU threshold
-            max_det=1000,  # оставляем лимит на количество детекций
-            device="",  # используем доступное устройство автоматически
-            view_img=False,  # не показываем окно OpenCV
-            save_txt=False,  # не сохраняем txt-разметку
-            save_csv=False,  # не сохраняем csv
-            save_conf=False,  # не сохраняем confidence в txt
-            save_crop=False,  # не сохраняем кропы
-            nosave=False,  # сохраняем результирующие изображения
-            classes=classes,  # передаём фильтр классов
-            agnostic_nms=False,  # не включаем class-agnostic NMS
-            augment=False,  # не включаем augmented inference
-            visualize=False,  # не сохраняем feature maps
-            update=False,  # не обновляем веса
-            project=str(project_path),  # указываем папку, куда сохранять результаты
-            name=str(name),  # указываем имя конкретной подпапки запуска
-            exist_ok=True,  # разрешаем использовать уже существующую папку после её очистки снаружи
-            line_thickness=3,  # толщина рамки вокруг объекта
-            hide_labels=False,  # показываем названия классов
-            hide_conf=False,  # показываем confidence
-            half=False,  # не включаем fp16 по умолчанию
-            dnn=False,  # не используем OpenCV DNN backend
-            vid_stride=1,  # для изображений не влияет, оставляем 1
-        )  # конец вызова yolov5_detect_run
-
-
-
-WORK_DIR = 'D:/UII/DataScience/16_OD/OD'
+from yolo_engine import (  # резидентные модели, пул инференса, микробатчинг, кодеки
+    CONF_FLOOR,
+    CascadePolicy,
+    InferencePool,
+    ModelRegistry,
+    PRIORITY_LOW,
+    PRIORITY_NORMAL,
+    PoolBusyError,
+    ProcessBackend,
+    ThreadBackend,
+    decode_image,
+    dhash,
+    load_class_names,
+    rescale_detections,
+    select_detections,
+)
+from cpu_layout import ThreadLayout, load_layout  # потоки PyTorch и ядра воркеров инференса
+from model_export import INT8_SUFFIX, prepare_runtimes  # экспорт весов в OpenVINO / ONNX Runtime / INT8 для CPU
+from webhook_server import build_web_app, run_webhook  # webhook-режим на aiohttp
+from metrics import (  # гистограммы стадий, счётчики кеша/отказов, эндпоинт /metrics
+    CACHE_LOOKUPS,
+    CASCADE,
+    ERRORS,
+    INFERRED,
+    REJECTIONS,
+    REQUESTS,
+    REQUEST_SECONDS,
+    STAGE_SECONDS,
+    TIMEOUTS,
+    add_metrics_route,
+    register_gauge,
+    start_metrics_server,
+)
+from result_cache import (  # память, индекс cache/, file_id, почти-дубликаты
+    DETECTIONS_FILE,
+    CacheEntry,
+    CacheIndex,
+    MemoryCache,
+    PHashIndex,
+    SentFileCache,
+    atomic_write,
+    pack_detections,
+    unpack_detections,
+)
+
+
+WORK_DIR = os.environ.get("WORK_DIR", 'D:/UII/DataScience/16_OD/OD')  # папка весов и кеша
 os.makedirs(WORK_DIR, exist_ok=True)
 
-yolov5 = TerraYoloV5(work_dir=WORK_DIR)  # фреймворк и рабочая папка
+DEFAULT_WEIGHTS = os.environ.get("YOLO_WEIGHTS", 'yolov5x.pt')   # веса по умолчанию (загружаются при старте бота)
+# Каскад fast-режима: сначала лёгкая модель, DEFAULT_WEIGHTS — только для «сомнительных» картинок; "" — выключен
+CASCADE_WEIGHTS = os.environ.get("YOLO_CASCADE_WEIGHTS", 'yolov5s.pt')
+# Формат инференса: "auto" — на CPU экспорт в OpenVINO/ONNX Runtime (что установлено), "pt" — PyTorch как есть,
+# "int8" — квантованная модель PyTorch для CPU (быстрее, но с потерей mAP: см. int8_eval.py)
+INFERENCE_FORMAT = os.environ.get("INFERENCE_FORMAT", "auto")
+INT8_CALIB_DIR = os.environ.get("INT8_CALIB_DIR") or str(CURRENT_DIR / "IMG_test")  # калибровка INT8
+EXPORT_DIR = os.path.join(WORK_DIR, "exported")  # проверенные артефакты экспорта (по хешу весов и версиям)
 
 # --- Администраторы (замени на свои Telegram id) -----------------------------
 ADMIN_USER_IDS = {
@@ -142,7 +147,29 @@ ADMIN_USER_IDS = {
 # --- Настройки «долгих» задач ------------------------------------------------
 DETECT_TIMEOUT_SEC = 180         # тайм-аут на одну задачу YOLO
 CACHE_MAX_ITEMS = 200            # максимум ключей в кеш-индексе
-CACHE_DIR = os.path.join(WORK_DIR, "cache")
+CACHE_MAX_BYTES = 512 * 1024 * 1024  # максимум места под cache/ (вытеснение по LRU)
+MEMORY_CACHE_MAX_BYTES = 64 * 1024 * 1024  # горячий кеш результатов в памяти (JPEG + file_id)
+NEAR_DUP_CACHE = True            # искать почти-дубликаты (пересжатие/ресайз) по перцептивному хешу
+NEAR_DUP_MAX_DISTANCE = 6        # порог расстояния Хэмминга для 64-битного dHash
+CACHE_TO_DISK = True             # сохранять детекции в cache/ (единственная запись на диск)
+CONF_BASE = 0.5                  # conf по умолчанию (fast и грид по IoU в pro)
+IOU_BASE = 0.45                  # IoU NMS по умолчанию (fast и грид по conf в pro)
+LINE_THICKNESS = 3               # толщина рамок при отрисовке
+HIDE_CONF = False                # подписи без уверенности (только имя класса)
+INFERENCE_BACKEND = "thread"     # "thread" — модель в процессе бота; "process" — в отдельных процессах (без GIL)
+INFERENCE_WORKERS = 2            # потоков (или процессов) инференса: forward, NMS, отрисовка
+THREAD_LAYOUT_FILE = os.path.join(WORK_DIR, "thread_layout.json")  # forward x потоки от tune_threads.py (своя для бэкенда)
+INFERENCE_QUEUE_MAX = 16         # сколько заявок может ждать; дальше — «занято, попробуйте позже»
+BATCH_WINDOW_MS = 20             # окно набора микробатча между пользователями, мс
+BATCH_MAX_SIZE = 10              # максимум картинок в одном forward (альбом до MEDIA_GROUP_MAX фото — одним)
+LANE_WEIGHTS = {"admin": 4.0, "fast": 3.0, "pro": 1.0}  # доли полос планировщика инференса
+USER_QUEUE_MAX = 5               # сколько фото пользователя может ждать своей очереди
+ALBUM_WAIT_SEC = 1.0             # альбом считается собранным, если новых фото нет столько секунд
+MEDIA_GROUP_MAX = 10             # лимит Telegram на число фото в одном send_media_group
+CASCADE_BAND = (0.25, 0.5)       # каскад: «сомнительный» бокс лёгкой модели — conf в этом интервале
+CASCADE_MAX_UNCERTAIN = 2        # каскад: сомнительных боксов больше — картинку считает тяжёлая модель
+CASCADE_ESCALATE_IF_EMPTY = True  # каскад: нет уверенных боксов выбранных классов — тоже эскалация
+CACHE_DIR = os.environ.get("CACHE_DIR") or os.path.join(WORK_DIR, "cache")
 os.makedirs(CACHE_DIR, exist_ok=True)
 
 # --- Пресеты классов COCO для кнопок -----------------------------------------
@@ -171,38 +198,124 @@ def build_classes_keyboard() -> InlineKeyboardMarkup:
     ])
 
 # === 0.5) Вспомогательные функции ===========================================
+def observe_stage(stage: str, seconds: float) -> None:
+    """Длительность стадии: в гистограмму /metrics и в тайминги текущего запроса (JSON-лог)."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    add_stage(stage, seconds)
+
+
+@contextmanager
+def timed(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_USER_IDS
 
 def safe_basename(path: str) -> str:
     return os.path.basename(path).replace("\\", "/").split("/")[-1]
 
-# === 0.6) Семафоры пользователей: один запрос за раз =========================
-_user_locks: Dict[int, asyncio.Lock] = {}
-
-def get_user_lock(user_id: int) -> asyncio.Lock:
-    if user_id not in _user_locks:
-        _user_locks[user_id] = asyncio.Lock()
-    return _user_locks[user_id]
+def parse_classes(classes_raw) -> Optional[List[int]]:
+    """Строка "0 1 2" / коллекция индексов / None -> список классов COCO для маски детекций (None — все классы)."""
+    if classes_raw is None:
+        return None
+    if isinstance(classes_raw, str):
+        return [int(item) for item in classes_raw.split() if item.strip()]
+    if isinstance(classes_raw, (list, tuple, set)):
+        return [int(item) for item in classes_raw]
+    return None
+
+# === 0.6) Очереди пользователей: фото обрабатываются по порядку ==============
+# У каждого пользователя в работе не больше одной задачи: остальные ждут в его FIFO.
+# Поэтому в общей очереди инференса от пользователя всегда максимум одна заявка —
+# пользователи обслуживаются по кругу, и «тяжёлый» пользователь не вытесняет остальных.
+_user_queues: Dict[int, asyncio.Queue] = {}
+_user_workers: Dict[int, asyncio.Task] = {}
+_user_jobs: Dict[int, int] = {}  # задач пользователя: в работе + ожидающие
+
+def enqueue_user_job(user_id: int, job: Callable[[], Awaitable[None]]) -> Optional[int]:
+    """Ставит задачу в FIFO пользователя; возвращает число задач впереди или None, если очередь полна."""
+    pending = _user_jobs.get(user_id, 0)
+    if pending > USER_QUEUE_MAX:  # одна в работе + USER_QUEUE_MAX ожидающих
+        return None
+    queue = _user_queues.setdefault(user_id, asyncio.Queue())
+    queue.put_nowait(job)
+    _user_jobs[user_id] = pending + 1
+    if user_id not in _user_workers:
+        _user_workers[user_id] = asyncio.create_task(_user_worker(user_id, queue))
+    return pending
+
+async def _user_worker(user_id: int, queue: asyncio.Queue) -> None:
+    while not queue.empty():
+        job = queue.get_nowait()
+        try:
+            await job()
+        except Exception:
+            ERRORS.inc(stage="job")
+            logger.exception("Ошибка задачи пользователя %s", user_id)
+        finally:
+            _user_jobs[user_id] -= 1
+    # между проверкой пустоты и удалением нет await — новая задача не потеряется
+    del _user_workers[user_id]
+    del _user_queues[user_id]
+    del _user_jobs[user_id]
 
 # === 0.7) Сервис детекции с кешем (ООП) ======================================
+@dataclass
+class ResultPart:
+    """Одна картинка результата: уходит пользователю, как только отрисована."""
+    key: str                       # ключ отрисованного результата (для запоминания file_id)
+    index: int                     # номер ячейки грида
+    total: int                     # сколько картинок в результате всего
+    image: bytes
+    file_id: Optional[str] = None  # уже отправлялась — можно переслать по file_id
+
+
+def _weights_label(weights: str) -> str:
+    """Веса в ключах кеша: результаты INT8-модели не смешиваются с результатами FP32."""
+    return f"{weights}+int8" if weights in INT8_WEIGHTS else weights
+
+
 class DetectionService:
     """
     Класс берёт на себя:
       - формирование параметров YOLO
-      - кеширование результатов (по хешу изображения + параметров)
-      - запуск TerraYoloV5 и возврат путей к результатам
+      - кеширование детекций по всем классам (по хешу изображения + весов) и готовых JPEG в памяти
+      - запуск бэкенда инференса и ленивую отрисовку под параметры запроса
     """
     def __init__(self,
                  work_dir: str,
                  cache_dir: str,
-                 yolov5_obj: TerraYoloV5,
-                 cache_max_items: int = 200):
+                 backend,  # ThreadBackend | ProcessBackend
+                 pool: InferencePool,
+                 cache_max_items: int = 200,
+                 cache_to_disk: bool = True,
+                 cache_max_bytes: int = 512 * 1024 * 1024,
+                 memory_cache_max_bytes: int = 64 * 1024 * 1024,
+                 near_dup_max_distance: Optional[int] = None,
+                 cascade_weights: Optional[str] = None,
+                 cascade_policy: Optional[CascadePolicy] = None):
         self.work_dir = work_dir
         self.cache_dir = cache_dir
-        self.yolov5 = yolov5_obj
-        self.cache_index: List[str] = []  # LRU-список ключей
-        self.cache_max_items = cache_max_items
+        self.backend = backend  # микробатчинг + forward/NMS, отрисовка по запросу
+        self.pool = pool  # ограниченный пул потоков инференса
+        self.cache_to_disk = cache_to_disk
+        # индекс восстанавливается с диска при старте и вытесняет по числу записей и по объёму
+        self.cache_index = CacheIndex(cache_dir, max_items=cache_max_items, max_bytes=cache_max_bytes)
+        self.memory_cache = MemoryCache(max_bytes=memory_cache_max_bytes)  # горячий уровень перед диском
+        self.sent_files = SentFileCache(cache_dir)  # file_unique_id входа -> file_id отправленных результатов
+        # почти-дубликаты: dHash -> ключ записи детекций (None — поиск выключен)
+        self.near_dup_max_distance = near_dup_max_distance
+        self.phash_index = PHashIndex(cache_dir) if near_dup_max_distance is not None else None
+        self.class_names = load_class_names()  # для отрисовки без модели (в т.ч. в режиме process)
+        # каскад fast: лёгкие веса первого прохода (None — fast сразу считает DEFAULT_WEIGHTS)
+        self.cascade_weights = cascade_weights or None
+        self.cascade_policy = cascade_policy or CascadePolicy()
+        self._background: set = set()  # задачи инференса, отдающие ячейки потребителю по мере готовности
 
     # ---------- Хеш ключа кеша ----------
     def _calc_cache_key(self,
@@ -212,140 +325,440 @@ class DetectionService:
                         conf: float,
                         iou: float,
                         classes_str: Optional[str]) -> str:
+        """Ключ отрисованного результата (горячий кеш в памяти и file_id): зависит от всех параметров."""
+        h = hashlib.sha256()
+        h.update(image_bytes)
+        h.update(self._params_sig(mode, weights, conf, iou, classes_str).encode('utf-8'))
+        h.update(f"|style={LINE_THICKNESS},{HIDE_CONF}|".encode('utf-8'))
+        return h.hexdigest()
+
+    @staticmethod
+    def _params_sig(mode: str, weights: str, conf: float, iou: float, classes_str: Optional[str]) -> str:
+        return f"|mode={mode}|weights={weights}|conf={conf}|iou={iou}|classes={classes_str or 'ALL'}|"
+
+    def _calc_det_key(self, image_bytes: bytes, weights: str) -> str:
+        """Ключ записи cache/: детекции по всем классам не зависят от режима, conf, фильтра и стиля."""
         h = hashlib.sha256()
         h.update(image_bytes)
-        payload = f"|mode={mode}|weights={weights}|conf={conf}|iou={iou}|classes={classes_str or 'ALL'}|"
-        h.update(payload.encode('utf-8'))
+        h.update(self._det_sig(weights).encode('utf-8'))
         return h.hexdigest()
 
+    @staticmethod
+    def _det_sig(weights: str) -> str:
+        return f"|weights={_weights_label(weights)}|classes=ALL|"
+
+    def _weights_sig(self, mode: str) -> str:
+        """Веса в ключах результата: у fast с каскадом — обе модели и пороги эскалации."""
+        if mode == "fast" and self.cascade_weights:
+            return f"{_weights_label(self.cascade_weights)}->{_weights_label(DEFAULT_WEIGHTS)}:{self.cascade_policy}"
+        return _weights_label(DEFAULT_WEIGHTS)
+
+    # ---------- Ключ повторной отправки по file_id ----------
+    def _sent_key(self, file_unique_id: str, mode: str, classes_str: Optional[str]) -> str:
+        payload = f"{file_unique_id}|mode={mode}|weights={self._weights_sig(mode)}|classes={classes_str or 'ALL'}"
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def find_sent(self, file_unique_id: str, mode: str, classes_str: Optional[str]) -> Optional[List[str]]:
+        """file_id ранее отправленных результатов для того же фото и тех же параметров."""
+        return self.sent_files.get(self._sent_key(file_unique_id, mode, classes_str))
+
+    def remember_sent(self, file_unique_id: str, mode: str, classes_str: Optional[str], file_ids: List[str]) -> None:
+        self.sent_files.put(self._sent_key(file_unique_id, mode, classes_str), file_ids)
+
+    def forget_sent(self, file_unique_id: str, mode: str, classes_str: Optional[str]) -> None:
+        self.sent_files.remove(self._sent_key(file_unique_id, mode, classes_str))
+
     # ---------- Проверка кеша ----------
-    def _cache_paths(self, cache_key: str) -> List[str]:
-        folder = os.path.join(self.cache_dir, cache_key)
-        if not os.path.isdir(folder):
-            return []
-        # возвращаем все картинки из папки кеша
-        return [os.path.join(folder, f) for f in sorted(os.listdir(folder))
-                if f.lower().endswith((".jpg", ".jpeg", ".png", ".bmp"))]
+    def _load_detections(self, det_key: str) -> Optional[Tuple[Tuple[int, int], Dict[float, np.ndarray]]]:
+        """Детекции записи cache/ по IoU (при conf = CONF_FLOOR) и размер картинки, по которой они посчитаны."""
+        paths = self.cache_index.lookup(det_key)
+        if not paths:
+            return None  # записи нет или она уже вытеснена
+        try:
+            with open(os.path.join(self.cache_dir, det_key, DETECTIONS_FILE), "rb") as fh:
+                return unpack_detections(fh.read())
+        except (OSError, ValueError, struct.error):
+            self.cache_index.remove(det_key)  # файл пропал/повреждён — запись больше не валидна
+            return None
 
     # ---------- Сохранить в кеш ----------
-    def _save_to_cache(self, cache_key: str, result_paths: List[str]) -> List[str]:
-        folder = os.path.join(self.cache_dir, cache_key)
-        os.makedirs(folder, exist_ok=True)
-        out_paths = []
-        for i, src in enumerate(result_paths, 1):
-            if not os.path.isfile(src):
+    def _save_detections(self, det_key: str, shape: Tuple[int, int], cells: Dict[float, np.ndarray]) -> None:
+        folder = os.path.join(self.cache_dir, det_key)
+        data = pack_detections(shape, cells)
+        try:
+            # тот же ключ могут параллельно сохранять и читать другие запросы (одно фото от двух пользователей)
+            os.makedirs(folder, exist_ok=True)
+            atomic_write(os.path.join(folder, DETECTIONS_FILE), data)
+        except OSError:  # в т.ч. папку только что вытеснил другой поток
+            return
+        self.cache_index.add(det_key, [DETECTIONS_FILE], len(data))  # LRU + вытеснение старого
+
+    # ---------- Почти-дубликаты ----------
+    async def _near_duplicate(self,
+                              phash: int,
+                              params: str,
+                              shape: Tuple[int, int],
+                              ious: List[float]) -> Optional[Dict[float, np.ndarray]]:
+        """Детекции похожей картинки (пересжатие/ресайз), перенесённые в координаты новой."""
+        for key in self.phash_index.find(phash, params, self.near_dup_max_distance):
+            cached = await self.pool.run(self._load_detections, key)
+            if cached is None:
                 continue
-            dst = os.path.join(folder, f"result_{i}_{safe_basename(src)}")
-            try:
-                shutil.copy2(src, dst)
-                out_paths.append(dst)
-            except Exception:
-                pass
-        # обновляем LRU
-        if cache_key in self.cache_index:
-            self.cache_index.remove(cache_key)
-        self.cache_index.insert(0, cache_key)
-        # чистим старое
-        while len(self.cache_index) > self.cache_max_items:
-            old_key = self.cache_index.pop()
-            shutil.rmtree(os.path.join(self.cache_dir, old_key), ignore_errors=True)
-        return out_paths
+            old_shape, cells = cached
+            if all(iou in cells for iou in ious):
+                return {iou: rescale_detections(det, old_shape, shape) for iou, det in cells.items()}
+        return None
+
+    # ---------- Запуск YOLO с параметрами ----------
+    # ---------- Режимы и полосы планировщика ----------
+    @staticmethod
+    def _grid(mode: str) -> List[Tuple[float, float]]:
+        """Набор порогов (conf, iou), которые считаем по ОДНОМУ forward."""
+        if mode == "pro":
+            grid = [(c, IOU_BASE) for c in (0.01, 0.50, 0.99)]   # a) грид по conf
+            grid += [(CONF_BASE, i) for i in (0.01, 0.50, 0.99)]  # b) грид по IoU (фиксируем conf)
+            return grid
+        return [(CONF_BASE, IOU_BASE)]
+
+    @staticmethod
+    def _lane(mode: str, user_id: Optional[int]) -> Tuple[str, int]:
+        """Полоса планировщика: тяжёлый грид не мешает быстрым запросам (в т.ч. админов)."""
+        if mode == "pro":
+            return "pro", PRIORITY_LOW
+        if user_id is not None and is_admin(user_id):
+            return "admin", PRIORITY_NORMAL
+        return "fast", PRIORITY_NORMAL
+
+    # ---------- Альбом: один батч на все фото ----------
+    async def detect_album(self,
+                           images: List[bytes],
+                           mode: str,
+                           user_id: Optional[int] = None) -> Dict[str, Tuple[Tuple[int, int], Dict[float, np.ndarray]]]:
+        """
+        Детекции всех фото альбома, которых нет в cache/, — одним вызовом бэкенда (одна группа микробатча).
+        Возвращает {ключ записи cache/: (размер, детекции)} для run_detection(prefetched=...).
+        Фото с ошибкой декодирования в ответ не попадают: ошибку покажет run_detection этого фото.
+        Почти-дубликаты для альбома не ищем — лишний dHash задержал бы весь батч.
+        """
+        # fast с каскадом начинает с лёгкой модели — её и считаем батчем, эскалация идёт обычным путём
+        weights = self.cascade_weights if mode == "fast" and self.cascade_weights else DEFAULT_WEIGHTS
+        ious = sorted({iou for _, iou in self._grid(mode)})
+        todo: List[Tuple[str, bytes]] = []
+        for image_bytes in images:
+            det_key = self._calc_det_key(image_bytes, weights)
+            cached = await self.pool.run(self._load_detections, det_key) if self.cache_to_disk else None
+            if cached is None or not all(iou in cached[1] for iou in ious):
+                todo.append((det_key, image_bytes))
+        if not todo:
+            return {}
+
+        lane, priority = self._lane(mode, user_id)
+        grid = [(CONF_FLOOR, iou) for iou in ious]
+        queued = time.perf_counter()
+        async with self.pool.slot(lane, user_id, cost=len(todo) * len(grid)):
+            observe_stage("queue_wait", time.perf_counter() - queued)
+            with timed("inference"):
+                results = await asyncio.wait_for(
+                    self.backend.detect_batch(os.path.join(self.work_dir, weights),
+                                              [image_bytes for _, image_bytes in todo], grid, None, priority),
+                    DETECT_TIMEOUT_SEC)
+
+        prefetched = {}
+        for (det_key, _), result in zip(todo, results):
+            if isinstance(result, Exception):
+                continue
+            prefetched[det_key] = (result.shape, dict(zip(ious, result.dets)))
+            if self.cache_to_disk:
+                with timed("save"):
+                    await self.pool.run(self._save_detections, det_key, result.shape, prefetched[det_key][1])
+        return prefetched
 
     # ---------- Запуск YOLO с параметрами ----------
     async def run_detection(self,
-                            image_path: str,
                             image_bytes: bytes,
                             mode: str,  # "fast" | "pro"
-                            selected_classes_str: Optional[str]) -> List[str]:
+                            selected_classes_str: Optional[str],
+                            user_id: Optional[int] = None,
+                            prefetched: Optional[Dict[str, tuple]] = None) -> AsyncIterator[ResultPart]:
         """
-        Возвращает список путей к изображениям-результатам для отправки пользователю.
+        Асинхронно отдаёт картинки результата (JPEG и, если уже отправлялись, file_id) по мере готовности.
+        При тайм-ауте готовые картинки успевают уйти пользователю, затем поднимается asyncio.TimeoutError.
+        prefetched — детекции, уже посчитанные detect_album (по ключу записи cache/).
         """
-        weights = 'yolov5x.pt'
+        weights = DEFAULT_WEIGHTS
+        weights_path = os.path.join(self.work_dir, weights)
+        prefetched = prefetched or {}
 
-        # Параметры по умолчанию
-        conf_base = 0.5
-        iou_base  = 0.45
+        # Ключ отрисованного результата
+        with timed("hash"):
+            cache_key = self._calc_cache_key(
+                image_bytes=image_bytes,
+                mode=mode,
+                weights=self._weights_sig(mode),
+                conf=CONF_BASE,
+                iou=IOU_BASE,
+                classes_str=selected_classes_str
+            )
+
+        # 1) Горячий кеш: готовые JPEG без обращений к диску
+        entry = self.memory_cache.get(cache_key)
+        CACHE_LOOKUPS.inc(tier="memory", result="miss" if entry is None else "hit")
+        if entry is not None:
+            for i, data in enumerate(entry.images):
+                yield ResultPart(cache_key, i, len(entry.images), data,
+                                 entry.file_ids[i] if entry.file_ids else None)
+            return
+
+        # 2) Режимы: набор порогов (conf, iou), которые считаем по ОДНОМУ forward
+        grid = self._grid(mode)
+        ious = sorted({iou for _, iou in grid})
+        lane, priority = self._lane(mode, user_id)
+
+        classes = parse_classes(selected_classes_str)
+
+        # 3) Детекции из cache/ (посчитаны при conf = CONF_FLOOR по каждому IoU):
+        #    conf-порог применяется уже после NMS — для NMS YOLOv5 это точный результат
+        cells: Dict[float, np.ndarray] = {}
+        shape = None
+        with timed("disk_cache"):
+            det_key = self._calc_det_key(image_bytes, weights)
+            cached = prefetched.get(det_key)
+            inferred = cached is not None  # посчитано батчем альбома — для кеша это промах
+            if cached is None and self.cache_to_disk:
+                cached = await self.pool.run(self._load_detections, det_key)
+            if cached is not None:
+                shape, cells = cached[0], dict(cached[1])
+        missing = [iou for iou in ious if iou not in cells]
+        if self.cache_to_disk:
+            CACHE_LOOKUPS.inc(tier="disk", result="miss" if missing or inferred else "hit")
+
+        # 3b) Почти-дубликат: переносим сохранённые детекции похожей картинки
+        det_params = self._det_sig(weights)
+        phash = None
+        if missing and self.phash_index is not None and self.cache_to_disk:
+            with timed("near_dup"):
+                phash = await self.pool.run(dhash, image_bytes)
+                if shape is None:
+                    shape = (await self.pool.run(decode_image, image_bytes)).shape[:2]
+                near = await self._near_duplicate(phash, det_params, shape, missing)
+            CACHE_LOOKUPS.inc(tier="near_dup", result="miss" if near is None else "hit")
+            if near is not None:
+                cells.update(near)
+                missing = []
+                await self.pool.run(self._save_detections, det_key, shape, cells)
+                await self.pool.run(self.phash_index.add, phash, det_params, det_key)
+
+        # 3c) Каскад (fast): тяжёлой модели нет в кеше — сначала лёгкая; её ответ принимаем, если он уверенный
+        if missing and mode == "fast" and self.cascade_weights:
+            small, small_inferred = await self._cascade_first_pass(image_bytes, IOU_BASE, classes, lane, user_id,
+                                                                   priority, prefetched, phash, shape)
+            inferred = inferred or small_inferred
+            if small is not None:
+                cells, missing = small, []
+
+        # 4) Инференс только для недостающих IoU — по всем классам, в отдельной задаче:
+        #    место в пуле не занято, пока пользователю отправляются уже готовые картинки
+        ready: asyncio.Queue = asyncio.Queue()
+        finished = not missing
+        if missing or inferred:  # одно фото — один раз, даже если каскад прогнал обе модели
+            INFERRED.inc(mode=mode)
+        if missing:
+            task = asyncio.create_task(self._infer_missing(ready, weights_path, image_bytes, cells, missing,
+                                                           det_key, phash, det_params, lane, user_id, priority))
+            self._background.add(task)  # задача доживает до сохранения, даже если пользователь ушёл
+            task.add_done_callback(self._background.discard)
+
+        # 5) Отрисовка по запросу: маска пресета классов и conf по готовым детекциям + аннотация.
+        #    NMS YOLOv5 подавляет боксы только внутри своего класса, поэтому маска после NMS точна.
+        images: List[Optional[bytes]] = [None] * len(grid)
+        while True:
+            todo = [i for i, (_, iou) in enumerate(grid) if images[i] is None and iou in cells]
+            if todo:
+                with timed("render"):
+                    rendered = await self.backend.render(
+                        image_bytes,
+                        [select_detections(cells[grid[i][1]], grid[i][0], classes) for i in todo],
+                        self.class_names, LINE_THICKNESS, HIDE_CONF, priority)
+                for i, data in zip(todo, rendered):
+                    images[i] = data
+                    yield ResultPart(cache_key, i, len(grid), data)
+            if finished or all(data is not None for data in images):
+                break
+            event = await ready.get()  # очередной IoU посчитан / None — конец / ошибка
+            if isinstance(event, Exception):
+                raise event
+            finished = event is None
+
+        if all(data is not None for data in images):
+            self.memory_cache.put(CacheEntry(cache_key, images))
+
+    async def _infer_missing(self,
+                             ready: asyncio.Queue,
+                             weights_path: str,
+                             image_bytes: bytes,
+                             cells: Dict[float, np.ndarray],
+                             missing: List[float],
+                             det_key: str,
+                             phash: Optional[int],
+                             det_params: str,
+                             lane: str,
+                             user_id: Optional[int],
+                             priority: int) -> None:
+        """Считает недостающие IoU, сообщая о каждом в очередь; посчитанное сохраняет даже при тайм-ауте."""
+        loop = asyncio.get_running_loop()
+        shape = None
+        queued = time.perf_counter()
+        try:
+            # Ждём места в своей полосе (DRR между пользователями), затем один тайм-аут на весь инференс
+            async with self.pool.slot(lane, user_id, cost=len(missing)):
+                observe_stage("queue_wait", time.perf_counter() - queued)
+                deadline = loop.time() + DETECT_TIMEOUT_SEC
+                stream = self.backend.detect_iter(weights_path, image_bytes,
+                                                  [(CONF_FLOOR, iou) for iou in missing], None, priority)
+                try:
+                    with timed("inference"):
+                        while True:
+                            try:
+                                i, det, shape = await asyncio.wait_for(stream.__anext__(), deadline - loop.time())
+                            except StopAsyncIteration:
+                                break
+                            cells[missing[i]] = det
+                            ready.put_nowait(missing[i])
+                finally:
+                    await stream.aclose()
+        except Exception as e:  # тайм-аут или ошибка инференса — потребитель поднимет её у себя
+            ready.put_nowait(e)
+        else:
+            ready.put_nowait(None)
+        if shape is not None and self.cache_to_disk:
+            with timed("save"):
+                await self.pool.run(self._save_detections, det_key, shape, dict(cells))
+                if phash is not None:
+                    await self.pool.run(self.phash_index.add, phash, det_params, det_key)
+
+    async def _cascade_first_pass(self,
+                                  image_bytes: bytes,
+                                  iou: float,
+                                  classes: Optional[List[int]],
+                                  lane: str,
+                                  user_id: Optional[int],
+                                  priority: int,
+                                  prefetched: Dict[str, tuple],
+                                  phash: Optional[int],
+                                  shape: Optional[Tuple[int, int]]) -> Tuple[Optional[Dict[float, np.ndarray]], bool]:
+        """Детекции лёгкой модели ({iou: det}), если по ним не нужна эскалация, иначе None;
+        и была ли лёгкая модель прогнана для этого запроса (в т.ч. батчем альбома).
+
+        Детекции лёгкой модели кешируются в cache/ под своим ключом, как и у тяжёлой: повтор
+        той же картинки не считает лёгкую модель заново, а решение об эскалации пересчитывается по ним.
+        phash (если индекс почти-дубликатов включён) записывается и под лёгкой моделью — при принятии
+        её ответа тяжёлая не запускается, и иначе пересжатая копия снова гоняла бы лёгкую.
+        """
+        weights = self.cascade_weights
+        det_key = self._calc_det_key(image_bytes, weights)
+        det_params = self._det_sig(weights)
+        cells: Dict[float, np.ndarray] = {}
+        cached = prefetched.get(det_key)
+        inferred = cached is not None
+        if cached is None and self.cache_to_disk:
+            cached = await self.pool.run(self._load_detections, det_key)
+        if cached is not None:
+            cells = dict(cached[1])
+        if iou not in cells and phash is not None:
+            with timed("near_dup"):
+                near = await self._near_duplicate(phash, det_params, shape, [iou])
+            if near is not None:
+                cells.update(near)
+                await self.pool.run(self._save_detections, det_key, shape, cells)
+        if iou not in cells:
+            inferred = True
+            ready: asyncio.Queue = asyncio.Queue()
+            await self._infer_missing(ready, os.path.join(self.work_dir, weights), image_bytes, cells, [iou],
+                                      det_key, None, det_params, lane, user_id, priority)
+            while (event := ready.get_nowait()) is not None:  # задача уже завершена — все события в очереди
+                if isinstance(event, Exception):
+                    raise event
+        if phash is not None:  # повторная запись ключа ничего не меняет
+            await self.pool.run(self.phash_index.add, phash, det_params, det_key)
+        reason = self.cascade_policy.escalate(cells[iou], classes)
+        CASCADE.inc(result=reason or "accepted")
+        return (None if reason else {iou: cells[iou]}), inferred
+
+    def remember_file_ids(self, cache_key: str, file_ids: List[str]) -> None:
+        """file_id отправленных фото — следующие попадания в горячий кеш уходят без загрузки."""
+        self.memory_cache.set_file_ids(cache_key, file_ids)
+
+# Инициализируем сервис. Не при импорте: процессы-воркеры (spawn) импортируют этот модуль заново,
+# и каждый иначе перестраивал бы cache/, проверял экспорт и поднимал свой пул. В воркерах живёт только yolo_engine.
+MODEL_PATHS: List[str] = []
+THREAD_LAYOUT: Optional[ThreadLayout] = None
+RUNTIME_PATHS: Dict[str, str] = {}
+INT8_WEIGHTS: set = set()
+model_registry: Optional[ModelRegistry] = None
+inference_pool: Optional[InferencePool] = None
+inference_backend = None  # ThreadBackend | ProcessBackend
+detector: Optional[DetectionService] = None
+
+
+def init_services() -> None:
+    """Логи, экспорт весов, модели, пул и бэкенд инференса, сервис детекции и метрики — один раз за процесс."""
+    global CASCADE_WEIGHTS, INFERENCE_WORKERS, MODEL_PATHS, THREAD_LAYOUT, RUNTIME_PATHS, INT8_WEIGHTS
+    global model_registry, inference_pool, inference_backend, detector
+    if detector is not None:
+        return
+    init_logging()
+    if CASCADE_WEIGHTS == DEFAULT_WEIGHTS:
+        CASCADE_WEIGHTS = ""  # каскад из одной модели — обычный fast
+    elif CASCADE_WEIGHTS and not os.path.exists(os.path.join(WORK_DIR, CASCADE_WEIGHTS)):
+        logger.warning("Веса каскада не найдены (%s) — fast считает %s", CASCADE_WEIGHTS, DEFAULT_WEIGHTS)
+        CASCADE_WEIGHTS = ""
+    MODEL_PATHS = [os.path.join(WORK_DIR, w) for w in (DEFAULT_WEIGHTS, CASCADE_WEIGHTS) if w]  # резидентные модели
+    # Ядра CPU: раскладка, подобранная tune_threads.py на этой машине для этого бэкенда, иначе — поровну
+    # между одновременными forward: в process их столько, сколько процессов; в thread — по одному на файл
+    # весов (каскад — два), но не больше потоков пула
+    if INFERENCE_BACKEND == "process":
+        THREAD_LAYOUT = load_layout(THREAD_LAYOUT_FILE, INFERENCE_BACKEND) or ThreadLayout.default(INFERENCE_WORKERS)
+        INFERENCE_WORKERS = THREAD_LAYOUT.workers
+    else:
+        THREAD_LAYOUT = (load_layout(THREAD_LAYOUT_FILE, INFERENCE_BACKEND)
+                         or ThreadLayout.default(min(len(MODEL_PATHS), INFERENCE_WORKERS)))
+    logger.info("Инференс (%s): %d forward одновременно x %d поток(а) PyTorch%s", INFERENCE_BACKEND,
+                THREAD_LAYOUT.workers, THREAD_LAYOUT.threads,
+                ", с закреплением за ядрами" if THREAD_LAYOUT.pin and INFERENCE_BACKEND == "process" else "")
+    # Первый старт экспортирует и сверяет с PyTorch, следующие — берут артефакт из EXPORT_DIR
+    RUNTIME_PATHS = prepare_runtimes(MODEL_PATHS, fmt=INFERENCE_FORMAT, batch=BATCH_MAX_SIZE,
+                                     export_dir=EXPORT_DIR, sample_dir=str(CURRENT_DIR / "IMG_test"),
+                                     calib_dir=INT8_CALIB_DIR)
+    INT8_WEIGHTS = {w for w in (DEFAULT_WEIGHTS, CASCADE_WEIGHTS)
+                    if w and RUNTIME_PATHS.get(os.path.join(WORK_DIR, w), "").endswith(INT8_SUFFIX)}
+    model_registry = ModelRegistry(device="", runtime_paths=RUNTIME_PATHS)  # модели живут в памяти всё время работы бота
+
+    inference_pool = InferencePool(workers=INFERENCE_WORKERS, max_queue=INFERENCE_QUEUE_MAX,
+                                   inflight=BATCH_MAX_SIZE,  # целый микробатч может быть в работе
+                                   lane_weights=LANE_WEIGHTS)
+    if INFERENCE_BACKEND == "process":
+        inference_backend = ProcessBackend(workers=INFERENCE_WORKERS,
+                                           weights_paths=MODEL_PATHS, runtime_paths=RUNTIME_PATHS,
+                                           window_ms=BATCH_WINDOW_MS, max_batch=BATCH_MAX_SIZE, layout=THREAD_LAYOUT)
+    else:
+        inference_backend = ThreadBackend(model_registry, inference_pool,
+                                          window_ms=BATCH_WINDOW_MS, max_batch=BATCH_MAX_SIZE, layout=THREAD_LAYOUT)
+    detector = DetectionService(WORK_DIR, CACHE_DIR, inference_backend, inference_pool,
+                                CACHE_MAX_ITEMS, CACHE_TO_DISK, CACHE_MAX_BYTES, MEMORY_CACHE_MAX_BYTES,
+                                NEAR_DUP_MAX_DISTANCE if NEAR_DUP_CACHE else None,
+                                cascade_weights=CASCADE_WEIGHTS or None,
+                                cascade_policy=CascadePolicy(band=CASCADE_BAND,
+                                                             max_uncertain=CASCADE_MAX_UNCERTAIN,
+                                                             escalate_if_empty=CASCADE_ESCALATE_IF_EMPTY))
+
+    # Значения, снимаемые в момент опроса /metrics
+    register_gauge("bot_inference_active", "Заявок в пуле инференса: в работе + в очереди", lambda: inference_pool.active)
+    register_gauge("bot_inference_waiting", "Заявок, ждущих места в стадии инференса", inference_pool.scheduler.waiting)
+    register_gauge("bot_user_jobs", "Фото пользователей: в работе + в личных очередях", lambda: sum(_user_jobs.values()))
+    register_gauge("bot_memory_cache_bytes", "Занято горячим кешем результатов, байт", lambda: detector.memory_cache.total_bytes)
+    register_gauge("bot_disk_cache_items", "Записей в cache/", lambda: detector.cache_index.total_items)
+    register_gauge("bot_disk_cache_bytes", "Занято cache/, байт", lambda: detector.cache_index.total_bytes)
 
-        # Ключ кеша для «быстрого» режима
-        cache_key = self._calc_cache_key(
-            image_bytes=image_bytes,
-            mode=mode,
-            weights=weights,
-            conf=conf_base,
-            iou=iou_base,
-            classes_str=selected_classes_str
-        )
-
-        # 1) Пробуем кеш
-        cached = self._cache_paths(cache_key)
-        if cached:
-            return cached
-
-        # 2) Готовим общую входную папку для TerraYolo
-        images_dir = os.path.join(self.work_dir, "images_in")
-        shutil.rmtree(images_dir, ignore_errors=True)
-        os.makedirs(images_dir, exist_ok=True)
-        local_name = safe_basename(image_path)
-        local_path = os.path.join(images_dir, local_name)
-        shutil.copy2(image_path, local_path)
-
-        # Базовый словарь параметров
-        test_dict = {
-            'weights': weights,
-            'source': images_dir,
-        }
-
-        result_paths: List[str] = []
-
-        async def _run_once(name: str,
-                            conf: float,
-                            iou: float,
-                            classes: Optional[str]) -> Optional[str]:
-            test_dict['name'] = name
-            test_dict['conf-thres'] = conf
-            test_dict['iou-thres'] = iou
-
-            if classes is not None:
-                test_dict['classes'] = classes
-            elif 'classes' in test_dict:
-                del test_dict['classes']
-
-            # чистим выход
-            out_dir = os.path.join(self.work_dir, "yolov5", "runs", "detect", name)
-            shutil.rmtree(out_dir, ignore_errors=True)
-
-            # Запускаем с тайм-аутом
-            await asyncio.wait_for(asyncio.to_thread(self.yolov5.run, test_dict, 'test'),
-                                   timeout=DETECT_TIMEOUT_SEC)
-
-            out_img = os.path.join(out_dir, local_name)
-            return out_img if os.path.exists(out_img) else None
-
-        # 3) Режимы
-        if mode == "fast":
-            out = await _run_once("fast_single", conf_base, iou_base, selected_classes_str)
-            if out:
-                result_paths.append(out)
-
-        elif mode == "pro":
-            # a) Грид по conf
-            for c in (0.01, 0.50, 0.99):
-                out = await _run_once(f"conf_{int(c*100):03d}", c, iou_base, selected_classes_str)
-                if out:
-                    result_paths.append(out)
-            # b) Грид по IoU (фиксируем conf)
-            for i in (0.01, 0.50, 0.99):
-                out = await _run_once(f"iou_{int(i*100):03d}", conf_base, i, selected_classes_str)
-                if out:
-                    result_paths.append(out)
-
-        # 4) Сохраняем в кеш «под ключ fast» (в т.ч. для pro — кешируем весь пакет)
-        if result_paths:
-            return self._save_to_cache(cache_key, result_paths)
-        return []
-
-# Инициализируем сервис
-detector = DetectionService(WORK_DIR, CACHE_DIR, yolov5, CACHE_MAX_ITEMS)
 
 # === 1) /start ===============================================================
 async def start(update, context):
@@ -424,72 +837,320 @@ async def set_pro(update, context):
     await update.message.reply_text("Режим установлен: *pro* (тяжёлый, грид по conf/IoU).", parse_mode="Markdown")
 
 # === 3) Обработка изображения (с кешем/лимитами) =============================
+def _incoming_image(message):
+    """PhotoSize/Document с картинкой из сообщения или None, если это не изображение."""
+    if message and message.photo:
+        return message.photo[-1]
+    if message and message.document and message.document.mime_type and message.document.mime_type.startswith('image/'):
+        return message.document
+    return None
+
+
+def _user_params(context, user) -> Tuple[str, Optional[str]]:
+    """Режим и фильтр классов пользователя."""
+    selected_str = context.user_data.get('selected_classes_str', CLASS_PRESETS['person'][1])
+    mode = context.user_data.get('mode', 'fast')
+    if mode == 'pro' and not is_admin(user.id):
+        mode = 'fast'  # безопасность: только админ может pro
+    return mode, selected_str
+
+
+async def _reply_from_sent(update, context, user) -> Tuple[bool, List[str]]:
+    """Повтор уже обработанного фото: отвечаем file_id прошлых результатов (без скачивания и инференса).
+
+    Возвращает (ответ отправлен целиком, file_id уже отправленных первых результатов).
+    """
+    media = _incoming_image(update.message)
+    if media is None:
+        return False, []
+    mode, selected_str = _user_params(context, user)
+    file_ids = await asyncio.to_thread(detector.find_sent, media.file_unique_id, mode, selected_str)
+    CACHE_LOOKUPS.inc(tier="sent", result="hit" if file_ids else "miss")
+    if not file_ids:
+        return False, []
+    sent: List[str] = []
+    try:
+        with timed("upload"):
+            for file_id in file_ids:
+                await update.message.reply_photo(file_id)
+                sent.append(file_id)
+    except BadRequest:
+        # file_id устарел — забываем и идём обычным путём; отправленное раньше не повторяем
+        await asyncio.to_thread(detector.forget_sent, media.file_unique_id, mode, selected_str)
+        return False, sent
+    return True, sent
+
+
+# --- Альбомы: обновления одной media group собираются в один пакет ----------
+_albums: Dict[str, list] = {}
+
+
+async def _collect_album(update) -> Optional[list]:
+    """Первое фото альбома ждёт остальные и возвращает все обновления; остальные — None."""
+    group_id = update.message.media_group_id
+    album = _albums.get(group_id)
+    if album is not None:
+        album.append(update)
+        return None
+    album = _albums[group_id] = [update]
+    try:
+        seen = 0
+        while len(album) != seen:  # Telegram присылает фото альбома подряд — ждём тишины
+            seen = len(album)
+            await asyncio.sleep(ALBUM_WAIT_SEC)
+    finally:
+        del _albums[group_id]
+    return album
+
+
 async def detection(update, context):
     user = update.effective_user
-    lock = get_user_lock(user.id)
 
-    if lock.locked():
-        await update.message.reply_text("⏳ У вас уже выполняется задача. Дождитесь её завершения, пожалуйста.")
+    # Альбом обрабатывается целиком: первое обновление группы собирает остальные
+    album = None
+    if update.message and update.message.media_group_id:
+        album = await _collect_album(update)
+        if album is None:
+            return
+
+    # Задача уходит в FIFO пользователя: лишние фото ждут, а не отбрасываются
+    queued = time.perf_counter()
+    ahead = enqueue_user_job(user.id, lambda: _run_job(update, context, user, album, queued))
+    if ahead is None:
+        REJECTIONS.inc(reason="user_queue_full")
+        await update.message.reply_text(
+            f"⏳ У вас уже {USER_QUEUE_MAX} фото в очереди. Дождитесь результатов, пожалуйста.")
+    elif ahead:
+        await update.message.reply_text(f"🕒 Фото в очереди. Перед ним ваших задач: {ahead}.")
+
+
+async def _run_job(update, context, user, album: Optional[list], queued: float):
+    start_request()  # request_id и тайминги стадий — для всех записей лога этой задачи
+    observe_stage("user_queue_wait", time.perf_counter() - queued)
+    mode, _ = _user_params(context, user)
+    REQUESTS.inc(mode=mode)
+
+    # То же фото с теми же параметрами уже отправляли — ответ без инференса
+    done, already_sent = await _reply_from_sent(update, context, user) if album is None else (False, [])
+    if done:
+        REQUEST_SECONDS.observe(time.perf_counter() - queued, mode=mode)
+        _log_request(user, mode, album, queued, "sent_file_id")
         return
 
-    async with lock:
-        # Получаем файл из Telegram
-        tg_file = None
-        image_name = None
-
-        if update.message and update.message.photo:
-            tg_file = await update.message.photo[-1].get_file()
-            image_name = safe_basename(tg_file.file_path) if tg_file.file_path else 'photo.jpg'
-        elif update.message and update.message.document and update.message.document.mime_type and update.message.document.mime_type.startswith('image/'):
-            tg_file = await update.message.document.get_file()
-            image_name = update.message.document.file_name or (safe_basename(tg_file.file_path) if tg_file.file_path else 'document_image.jpg')
+    # Контроль допуска: при переполненной очереди отказываем сразу, ещё до скачивания
+    try:
+        ahead = inference_pool.admit()
+    except PoolBusyError:
+        REJECTIONS.inc(reason="pool_busy")
+        _log_request(user, mode, album, queued, "pool_busy")
+        await update.message.reply_text("🚦 Сервер сейчас перегружен. Попробуйте, пожалуйста, чуть позже.")
+        return
+
+    try:
+        if album is None:
+            await _process_image(update, context, user, ahead, already_sent)
         else:
-            await update.message.reply_text('Похоже, это не изображение. Пришлите, пожалуйста, фото или картинку.')
-            return
+            await _process_album(album, context, user, ahead)
+    finally:
+        inference_pool.leave()
+        REQUEST_SECONDS.observe(time.perf_counter() - queued, mode=mode)
+        _log_request(user, mode, album, queued, "processed")
+
+
+def _log_request(user, mode: str, album: Optional[list], queued: float, outcome: str) -> None:
+    """Одна структурированная запись на запрос: итог, полное время и разбивка по стадиям."""
+    elapsed = time.perf_counter() - queued
+    logger.info("Запрос: %s, %.3f с", outcome, elapsed, extra={
+        "event": "request",
+        "user_id": user.id,
+        "mode": mode,
+        "photos": len(album) if album else 1,
+        "outcome": outcome,
+        "seconds": round(elapsed, 4),
+        "stages": request_stages(),
+    })
+
+
+def _status_text(ahead: int, received: str = "Изображение получено") -> str:
+    """Статус «получено» с позицией в очереди, если все воркеры заняты."""
+    status_text = f"📥 {received}. Проверяю кеш…"
+    if ahead:
+        wait = inference_pool.expected_wait(ahead)
+        status_text += f"\n⏳ Перед вами в очереди: {ahead}"
+        if wait is not None:
+            status_text += f" (≈{int(wait) + 1} с)"
+    return status_text
+
+
+async def _download(media) -> bytes:
+    # Скачиваем сразу в память (без tmp_in/ на диске)
+    with timed("download"):
+        tg_file = await media.get_file()
+        return bytes(await tg_file.download_as_bytearray())
+
+
+async def _process_image(update, context, user, ahead: int, already_sent: Sequence[str] = ()):
+    """Одно фото; already_sent — file_id первых результатов, уже отправленных из кеша file_id (не дублируем)."""
+    # Получаем файл из Telegram
+    media = _incoming_image(update.message)
+    if media is None:
+        await update.message.reply_text('Похоже, это не изображение. Пришлите, пожалуйста, фото или картинку.')
+        return
+    image_bytes = await _download(media)
 
-        # Скачиваем в локальную tmp-папку
-        tmp_dir = os.path.join(WORK_DIR, "tmp_in")
-        shutil.rmtree(tmp_dir, ignore_errors=True)
-        os.makedirs(tmp_dir, exist_ok=True)
-        image_path = os.path.join(tmp_dir, image_name)
-        await tg_file.download_to_drive(image_path)
+    # Параметры пользователя
+    mode, selected_str = _user_params(context, user)
 
-        # Читаем байты для хеша
-        with open(image_path, "rb") as f:
-            image_bytes = f.read()
+    # Статусные сообщения (с позицией в очереди, если все воркеры заняты)
+    processing_msg = await update.message.reply_text(_status_text(ahead))
 
-        # Параметры пользователя
-        selected_str = context.user_data.get('selected_classes_str', CLASS_PRESETS['person'][1])
-        mode = context.user_data.get('mode', 'fast')
-        if mode == 'pro' and not is_admin(user.id):
-            mode = 'fast'  # безопасность: только админ может pro
+    # Запуск детекции через сервис: картинки отправляем по мере готовности
+    sent_ids: List[Optional[str]] = []
+    count = 0
+    try:
+        async for part in detector.run_detection(
+            image_bytes=image_bytes,
+            mode=mode,
+            selected_classes_str=selected_str,
+            user_id=user.id
+        ):
+            if count == 0:
+                sent_ids = [None] * part.total
+                sent_ids[:len(already_sent)] = already_sent
+                await processing_msg.edit_text(f"Готово. Режим: *{mode}*. Отправляю результаты…", parse_mode="Markdown")
+            count += 1
+            if part.index < len(already_sent):  # эту картинку пользователь уже получил
+                continue
+            msg = None
+            with timed("upload"):
+                if part.file_id:  # уже отправляли — Telegram возьмёт файл у себя, без загрузки
+                    try:
+                        msg = await update.message.reply_photo(part.file_id)
+                    except BadRequest:
+                        msg = None
+                if msg is None:
+                    msg = await update.message.reply_photo(io.BytesIO(part.image))
+            if msg.photo:
+                sent_ids[part.index] = msg.photo[-1].file_id
+    except asyncio.TimeoutError:
+        TIMEOUTS.inc(mode=mode)
+        if count:  # уже отправленные картинки остаются у пользователя
+            await update.message.reply_text(f"⚠️ Время обработки истекло: отправлено {count} из {len(sent_ids)} результатов.")
+        else:
+            await processing_msg.edit_text("❌ Время обработки истекло. Попробуйте ещё раз (или используйте /fast).")
+        return
+    except Exception as e:
+        ERRORS.inc(stage="detection")
+        if count:
+            await update.message.reply_text(f"❌ Ошибка обработки: {e}")
+        else:
+            await processing_msg.edit_text(f"❌ Ошибка обработки: {e}")
+        return
 
-        # Статусные сообщения
-        processing_msg = await update.message.reply_text("📥 Изображение получено. Проверяю кеш…")
+    # Вывод результатов
+    if not count:
+        await processing_msg.edit_text("Готово. Объекты не найдены или результат не сформирован.")
+        return
 
-        try:
-            # Запуск детекции через сервис
-            results = await detector.run_detection(
-                image_path=image_path,
-                image_bytes=image_bytes,
-                mode=mode,
-                selected_classes_str=selected_str
-            )
-        except asyncio.TimeoutError:
+    if None not in sent_ids:  # всё отправлено: следующий повтор этого фото — вообще без скачивания
+        detector.remember_file_ids(part.key, sent_ids)
+        await asyncio.to_thread(detector.remember_sent, media.file_unique_id, mode, selected_str, sent_ids)
+
+
+def _media_group_bounds(total: int) -> List[Tuple[int, int]]:
+    """Границы пачек send_media_group: Telegram принимает от 2 до MEDIA_GROUP_MAX фото.
+
+    Пачка из одного фото бывает только при total == 1: иначе предпоследняя пачка отдаёт ей фото.
+    """
+    bounds, start = [], 0
+    while start < total:
+        end = min(start + MEDIA_GROUP_MAX, total)
+        if total - end == 1:  # осталось бы одно фото на последнюю пачку
+            end -= 1
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+async def _send_photos(message, parts: List[ResultPart]) -> list:
+    """Пачка результатов: несколько — одним send_media_group, одна — reply_photo (группу из 1 фото API отклоняет)."""
+    async def send(by_file_id: bool) -> list:
+        photos = [p.file_id if by_file_id and p.file_id else p.image for p in parts]
+        if len(photos) == 1:
+            return [await message.reply_photo(photos[0])]
+        return await message.reply_media_group([InputMediaPhoto(photo) for photo in photos])
+
+    try:
+        return await send(by_file_id=True)
+    except BadRequest:
+        if not any(p.file_id for p in parts):
+            raise
+        # устаревший file_id — отправляем те же картинки байтами
+        return await send(by_file_id=False)
+
+
+async def _process_album(updates: list, context, user, ahead: int):
+    """Альбом: сначала скачиваем все фото, затем один батч инференса на всё, ответ — send_media_group."""
+    message = updates[0].message
+    medias = [m for m in (_incoming_image(u.message) for u in updates) if m is not None]
+    mode, selected_str = _user_params(context, user)
+    processing_msg = await message.reply_text(_status_text(ahead, f"Альбом получен ({len(medias)} фото)"))
+
+    downloads = await asyncio.gather(*(_download(m) for m in medias), return_exceptions=True)
+    images = [b for b in downloads if isinstance(b, bytes)]
+    try:
+        prefetched = await detector.detect_album(images, mode, user.id)
+    except asyncio.TimeoutError:
+        TIMEOUTS.inc(mode=mode)
+        await processing_msg.edit_text("❌ Время обработки истекло. Попробуйте ещё раз (или используйте /fast).")
+        return
+    except Exception as e:  # батч не удался — каждое фото пройдёт обычный путь и покажет свою ошибку
+        logger.warning("Батч альбома не посчитан: %s", e)
+        prefetched = {}
+
+    async def run_one(image_bytes) -> list:
+        if isinstance(image_bytes, BaseException):
+            raise image_bytes  # фото не скачалось
+        return [part async for part in detector.run_detection(image_bytes=image_bytes, mode=mode,
+                                                               selected_classes_str=selected_str,
+                                                               user_id=user.id, prefetched=prefetched)]
+
+    results = await asyncio.gather(*(run_one(b) for b in downloads), return_exceptions=True)
+    for r in results:
+        if isinstance(r, asyncio.TimeoutError):
+            TIMEOUTS.inc(mode=mode)
+        elif isinstance(r, BaseException):
+            ERRORS.inc(stage="detection")
+    done = [(media, parts) for media, parts in zip(medias, results) if not isinstance(parts, BaseException) and parts]
+    failed = len(medias) - len(done)
+    if not done:
+        error = next((r for r in results if isinstance(r, BaseException)), None)
+        if isinstance(error, asyncio.TimeoutError):
             await processing_msg.edit_text("❌ Время обработки истекло. Попробуйте ещё раз (или используйте /fast).")
-            return
-        except Exception as e:
-            await processing_msg.edit_text(f"❌ Ошибка обработки: {e}")
-            return
+        else:
+            await processing_msg.edit_text(f"❌ Ошибка обработки: {error}" if error else "Готово. Объекты не найдены.")
+        return
 
-        # Вывод результатов
-        if not results:
-            await processing_msg.edit_text("Готово. Объекты не найдены или результат не сформирован.")
-            return
+    status = f"Готово. Режим: *{mode}*. Отправляю результаты…"
+    if failed:
+        status += f"\n⚠️ Не удалось обработать фото: {failed}"
+    await processing_msg.edit_text(status, parse_mode="Markdown")
+
+    # Все картинки альбома — пачками до MEDIA_GROUP_MAX в одном запросе
+    flat = [(n, part) for n, (_, parts) in enumerate(done) for part in parts]
+    sent_ids: List[List[Optional[str]]] = [[None] * parts[0].total for _, parts in done]
+    for start, end in _media_group_bounds(len(flat)):
+        chunk = flat[start:end]
+        with timed("upload"):
+            msgs = await _send_photos(message, [p for _, p in chunk])
+        for (n, part), msg in zip(chunk, msgs):
+            if msg.photo:
+                sent_ids[n][part.index] = msg.photo[-1].file_id
 
-        await processing_msg.edit_text(f"Готово. Режим: *{mode}*. Отправляю результаты…", parse_mode="Markdown")
-        for p in results:
-            await update.message.reply_photo(p)
+    for (media, parts), ids in zip(done, sent_ids):
+        if None not in ids:
+            detector.remember_file_ids(parts[0].key, ids)
+            await asyncio.to_thread(detector.remember_sent, media.file_unique_id, mode, selected_str, ids)
 
 
 
@@ -532,17 +1193,39 @@ async def error_handler(update, context) -> None:  # обработчик оши
         logger.warning("Network error while polling: %s", err)  # логируем кратко без traceback
         return  # выходим без traceback
 
+    ERRORS.inc(stage="unhandled")
     logger.exception("Unhandled exception in bot: %s", err)  # все остальные ошибки пишем с traceback
 
 
-def main():
-    application = (
+# --- Сервер метрик (polling): поднимается и гасится вместе с приложением ----
+async def _post_init(app):
+    await _setup_commands(app)
+    if BOT_MODE != "webhook":  # в webhook-режиме /metrics отдаёт сервер вебхука
+        app.bot_data["metrics_runner"] = await start_metrics_server(METRICS_LISTEN, METRICS_PORT)
+
+
+async def _post_shutdown(app):
+    runner = app.bot_data.pop("metrics_runner", None)
+    if runner is not None:
+        await runner.cleanup()
+    inference_backend.shutdown()  # процессы инференса (режим process) — не дожидаясь выхода интерпретатора
+
+
+def build_application() -> Application:
+    builder = (
         Application.builder()
         .token(TOKEN)
-        .post_init(_setup_commands)   # <-- ВАЖНО: здесь, на builder
-        .build()
+        .post_init(_post_init)   # <-- ВАЖНО: здесь, на builder
+        .post_shutdown(_post_shutdown)
     )
-    print('Бот запущен...')
+    if TELEGRAM_API_BASE_URL:  # например, http://127.0.0.1:8081 — локальный Bot API или фейк
+        base = TELEGRAM_API_BASE_URL.rstrip("/")
+        builder = builder.base_url(f"{base}/bot").base_file_url(f"{base}/file/bot")
+    application = builder.build()
+    init_services()
+
+    # Прогреваем модель заранее: первый пользователь не ждёт загрузку весов
+    inference_backend.preload(MODEL_PATHS)
 
     # Команды
     application.add_handler(CommandHandler("start", start))
@@ -563,6 +1246,23 @@ def main():
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, help))
 
     application.add_error_handler(error_handler)  # регистрируем обработчик ошибок, чтобы 502 не спамил traceback
+    return application
+
+
+def main():
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        # вебхук настроен снаружи: случайный секрет не совпал бы с заданным в setWebhook — все обновления 403
+        raise SystemExit("BOT_MODE=webhook без WEBHOOK_URL: задайте WEBHOOK_SECRET, тот же, что в setWebhook")
+    application = build_application()
+    print('Бот запущен...')
+
+    if BOT_MODE == "webhook":
+        # обновления приходят на локальный HTTP-сервер: без getUpdates каждые 10 секунд
+        web_app = build_web_app(application, WEBHOOK_PATH, WEBHOOK_SECRET)
+        add_metrics_route(web_app)  # /metrics рядом с /healthz
+        asyncio.run(run_webhook(application, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+                                public_url=WEBHOOK_URL, web_app=web_app))
+        return
 
     application.run_polling(  # запускаем polling
         drop_pending_updates=True,  # не обрабатываем накопившиеся апдейты после долгого оффлайна
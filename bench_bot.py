@@ -0,0 +1,437 @@
+"""Нагрузочный стенд: локальный фейк Telegram Bot API + синтетические пользователи против настоящего бота.
+
+Поднимает aiohttp-сервер, который отвечает на getUpdates/getFile/скачивание/sendPhoto/sendMessage/
+editMessageText как Telegram, запускает Application из KhiminArtemAI_03.py (polling на фейк) и
+гоняет N пользователей, каждый из которых шлёт фото из IMG_test/ и ждёт ответ (замкнутый цикл).
+
+Пример:
+    python bench_bot.py --users 8 --photos 10 --work-dir D:/UII/DataScience/16_OD/OD --unique
+
+Стресс-тест параллельности (--stress): все пользователи одновременно шлют одни и те же фото;
+проверяется, что каждый получил результат своего фото и что записи cache/ не повреждены.
+    python bench_bot.py --stress --users 16 --photos 6 --work-dir D:/UII/DataScience/16_OD/OD
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import asyncio
+import argparse
+import struct
+import hashlib
+import itertools
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from metrics import INFERRED, REGISTRY  # noqa: E402
+from yolo_engine import IMAGE_EXTS  # noqa: E402
+
+BOT_TOKEN = "123456:BENCH"  # фейковый токен: уходит только на локальный сервер
+FAIL_PREFIXES = ("❌", "🚦", "⏳")  # ответы бота, означающие, что фото не обработано
+
+
+@dataclass
+class Request:
+    """Одно фото синтетического пользователя и отметки времени, увиденные фейковым API."""
+    user_id: int
+    expected: int                      # сколько фото должен прислать бот (fast — 1, pro — 6)
+    t_sent: float                      # фото «отправлено пользователем» (доступно в getUpdates)
+    t_get_file: Optional[float] = None  # бот запросил getFile (задача взята из очереди пользователя)
+    t_status: Optional[float] = None    # «Изображение получено» — файл скачан
+    t_ready: Optional[float] = None     # «Готово…» — первый результат посчитан
+    t_done: Optional[float] = None      # последнее фото результата получено
+    photos: int = 0
+    input_key: str = ""                # file_unique_id входного фото
+    outputs: List[str] = field(default_factory=list)  # file_id присланных результатов (по содержимому)
+    failed: bool = False
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class FakeBotAPI:
+    """Минимальный Bot API: ровно те методы, которые вызывает бот, с правдоподобными ответами."""
+
+    def __init__(self) -> None:
+        self.updates: List[dict] = []
+        self._new_update = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.files: Dict[str, bytes] = {}            # file_id -> содержимое
+        self.current: Dict[int, Request] = {}        # chat_id -> запрос в работе
+        self.by_file: Dict[str, Request] = {}        # file_id входного фото -> запрос
+        self.uploaded_bytes = 0
+
+    # ---------- Сторона пользователя ----------
+    def send_text(self, user_id: int, text: str) -> None:
+        message = self._message(user_id, text=text)
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self._push({"message": message})
+
+    def send_photo(self, user_id: int, data: bytes, request: Request) -> None:
+        unique = hashlib.sha1(data).hexdigest()[:16]  # как в Telegram: тот же файл — тот же file_unique_id
+        file_id = f"in_{unique}_{next(self._message_ids)}"
+        self.files[file_id] = data
+        self.by_file[file_id] = request
+        request.input_key = unique
+        self.current[user_id] = request
+        h, w = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8).shape[:2]
+        photo = [{"file_id": file_id, "file_unique_id": unique, "width": w * 8, "height": h * 8,
+                  "file_size": len(data)}]
+        self._push({"message": self._message(user_id, photo=photo)})
+
+    def _message(self, user_id: int, **fields) -> dict:
+        return {"message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}, **fields}
+
+    def _push(self, update: dict) -> None:
+        update["update_id"] = next(self._update_ids)
+        self.updates.append(update)
+        self._new_update.set()
+
+    # ---------- Сторона бота (HTTP) ----------
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._api)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._download)
+        return app
+
+    async def _api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        handler = getattr(self, f"_m_{method}", None)
+        result = await handler(params) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _download(self, request: web.Request) -> web.Response:
+        data = self.files.get(request.match_info["path"])
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data, content_type="image/jpeg")
+
+    async def _m_getMe(self, params) -> dict:
+        return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+    async def _m_getUpdates(self, params) -> list:
+        offset = int(params.get("offset") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]  # подтверждённые убираем
+        if not self.updates:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get("limit") or 100)]
+
+    async def _m_getFile(self, params) -> dict:
+        file_id = params["file_id"]
+        req = self.by_file.get(file_id)
+        if req is not None and req.t_get_file is None:
+            req.t_get_file = time.perf_counter()
+        return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.files[file_id]),
+                "file_path": file_id}
+
+    def _reply(self, params, **fields) -> dict:
+        chat_id = int(params["chat_id"])
+        return {"message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, **fields}
+
+    async def _m_sendMessage(self, params) -> dict:
+        req = self.current.get(int(params["chat_id"]))
+        text = params.get("text", "")
+        if req is not None:
+            if text.startswith("📥") and req.t_status is None:
+                req.t_status = time.perf_counter()
+            elif text.startswith(FAIL_PREFIXES):
+                self._finish(req, failed=True)
+        return self._reply(params, text=text)
+
+    async def _m_editMessageText(self, params) -> dict:
+        req = self.current.get(int(params["chat_id"]))
+        text = params.get("text", "")
+        if req is not None:
+            if text.startswith("Готово") and req.t_ready is None:
+                req.t_ready = time.perf_counter()
+            elif text.startswith(FAIL_PREFIXES):
+                self._finish(req, failed=True)
+        return self._reply(params, text=text)
+
+    def _photo_result(self, params, photo) -> dict:
+        if hasattr(photo, "file"):  # загрузка байтов (multipart)
+            data = photo.file.read()
+            self.uploaded_bytes += len(data)
+            file_id = f"out_{hashlib.sha1(data).hexdigest()[:16]}"
+        else:  # повторная отправка по file_id
+            file_id = str(photo)
+        return self._reply(params, photo=[{"file_id": file_id, "file_unique_id": file_id[-16:],
+                                           "width": 640, "height": 640}])
+
+    def _count_photos(self, chat_id: int, file_ids: List[str]) -> None:
+        req = self.current.get(chat_id)
+        if req is None:
+            return
+        if req.t_ready is None:  # ответ по file_id без статусных сообщений
+            req.t_ready = time.perf_counter()
+        req.photos += len(file_ids)
+        req.outputs.extend(file_ids)
+        if req.photos >= req.expected:
+            self._finish(req)
+
+    async def _m_sendPhoto(self, params) -> dict:
+        result = self._photo_result(params, params["photo"])
+        self._count_photos(int(params["chat_id"]), [result["photo"][0]["file_id"]])
+        return result
+
+    async def _m_sendMediaGroup(self, params) -> list:
+        media = json.loads(params["media"])
+        results = []
+        for item in media:
+            ref = item["media"]
+            photo = params.get(ref[len("attach://"):]) if ref.startswith("attach://") else ref
+            results.append(self._photo_result(params, photo))
+        self._count_photos(int(params["chat_id"]), [r["photo"][0]["file_id"] for r in results])
+        return results
+
+    def _finish(self, req: Request, failed: bool = False) -> None:
+        req.failed = failed
+        req.t_done = time.perf_counter()
+        if self.current.get(req.user_id) is req:
+            del self.current[req.user_id]
+        req.done.set()
+
+
+# --- Синтетические пользователи -------------------------------------------------
+def load_images(folder: str) -> List[np.ndarray]:
+    images = [cv2.imread(str(p)) for p in sorted(Path(folder).iterdir()) if p.suffix.lower() in IMAGE_EXTS]
+    images = [im for im in images if im is not None]
+    if not images:
+        raise SystemExit(f"В {folder} нет изображений")
+    return images
+
+
+def make_photo(im: np.ndarray, unique: bool, rng: random.Random) -> bytes:
+    """JPEG как после сжатия Telegram; unique — лёгкий шум, чтобы байты (и хеш) каждый раз отличались."""
+    if unique:
+        im = im.copy()
+        y, x = rng.randrange(im.shape[0]), rng.randrange(im.shape[1])
+        im[y, x] = (im[y, x].astype(np.int16) + rng.randint(1, 40)).clip(0, 255).astype(np.uint8)
+    return cv2.imencode(".jpg", im, [cv2.IMWRITE_JPEG_QUALITY, 87])[1].tobytes()
+
+
+async def run_user(api: FakeBotAPI, user_id: int, images: List[np.ndarray], args, results: List[Request]) -> None:
+    rng = random.Random(user_id)
+    expected = 6 if args.mode == "pro" else 1
+    for n in range(args.photos):
+        # в стресс-тесте на каждом шаге все пользователи шлют одно и то же фото — максимум гонок по ключу
+        im = images[n % len(images)] if args.stress else images[(user_id + n) % len(images)]
+        data = await asyncio.to_thread(make_photo, im, args.unique, rng)
+        req = Request(user_id, expected, time.perf_counter())
+        api.send_photo(user_id, data, req)
+        try:
+            await asyncio.wait_for(req.done.wait(), args.request_timeout)
+        except asyncio.TimeoutError:
+            req.failed = True
+            api.current.pop(user_id, None)
+        results.append(req)
+        if args.think_ms:
+            await asyncio.sleep(args.think_ms / 1000)
+
+
+# --- Отчёт ----------------------------------------------------------------------
+def percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else float("nan")
+
+
+def report(results: List[Request], wall: float, bot, api: FakeBotAPI, inferences: int) -> dict:
+    ok = [r for r in results if not r.failed]
+    latency = [r.t_done - r.t_sent for r in ok]
+    mem = bot.detector.memory_cache.stats()
+    sent = bot.detector.sent_files
+    summary = {
+        "requests": len(results),
+        "ok": len(ok),
+        "failed": len(results) - len(ok),
+        "wall_sec": wall,
+        "throughput_rps": len(ok) / wall if wall else 0.0,
+        "latency_p50": percentile(latency, 50),
+        "latency_p95": percentile(latency, 95),
+        "latency_p99": percentile(latency, 99),
+        # ответы без прогона модели: file_id, память, cache/ и почти-дубликаты
+        "cache_hit_rate": max(0.0, 1 - inferences / len(ok)) if ok else 0.0,
+        "file_id_hits": sent.hits,
+        "memory_hits": mem["hits"],
+        "inferences": inferences,
+        "uploaded_mb": api.uploaded_bytes / 2 ** 20,
+        "cascade": {result: bot.CASCADE.value(result=result) for result in ("accepted", "empty", "uncertain")},
+        "stages": {},
+    }
+    # Стадии — из гистограммы бота (bot_stage_seconds), а не из отметок фейкового API: так очередь
+    # инференса, сам инференс, отрисовка и выгрузка видны по отдельности. p95 — оценка по корзинам.
+    stages = {
+        "очередь пользователя": "user_queue_wait",
+        "скачивание": "download",
+        "очередь инференса": "queue_wait",
+        "инференс": "inference",
+        "отрисовка": "render",
+        "выгрузка": "upload",
+    }
+    for name, label in stages.items():
+        _, total, count = bot.STAGE_SECONDS.snapshot(stage=label)
+        summary["stages"][name] = {"stage": label, "mean": total / count if count else float("nan"),
+                                   "p95": bot.STAGE_SECONDS.quantile(0.95, stage=label), "n": count}
+
+    print(f"\nЗапросов: {summary['requests']} (успешно {summary['ok']}, ошибок {summary['failed']})"
+          f" за {wall:.2f} с")
+    print(f"Пропускная способность: {summary['throughput_rps']:.2f} фото/с")
+    print(f"Задержка end-to-end, с: p50={summary['latency_p50']:.3f}  p95={summary['latency_p95']:.3f}"
+          f"  p99={summary['latency_p99']:.3f}")
+    print(f"Кеш: hit rate={summary['cache_hit_rate']:.1%} (из них file_id: {sent.hits}, память: {mem['hits']}),"
+          f" фото через инференс: {inferences}, выгружено {summary['uploaded_mb']:.1f} МБ")
+    if any(summary["cascade"].values()):
+        c = summary["cascade"]
+        print(f"Каскад: принят ответ лёгкой модели {c['accepted']:g}, эскалаций: нет уверенных боксов {c['empty']:g},"
+              f" сомнительные боксы {c['uncertain']:g}")
+    print("Разбивка по стадиям (среднее / p95, с; n — замеров: у pro отрисовка и выгрузка — по частям):")
+    for name, st in summary["stages"].items():
+        print(f"  {name:<32} {st['mean']:.3f} / {st['p95']:.3f}  (n={st['n']})")
+    return summary
+
+
+def check_isolation(results: List[Request], cache_dir: str) -> dict:
+    """Проверки стресс-теста: ответы не перепутаны между запросами, записи cache/ читаются целиком."""
+    from result_cache import DETECTIONS_FILE, unpack_detections
+
+    ok = [r for r in results if not r.failed]
+    by_input: Dict[str, set] = {}
+    owners: Dict[str, set] = {}
+    for r in ok:
+        by_input.setdefault(r.input_key, set()).add(tuple(sorted(r.outputs)))  # pro: порядок ячеек любой
+        for file_id in r.outputs:
+            owners.setdefault(file_id, set()).add(r.input_key)
+    inconsistent = sum(len(variants) > 1 for variants in by_input.values())  # одно фото — разные ответы
+    foreign = sum(len(keys) > 1 for keys in owners.values())  # один результат у разных фото
+    incomplete = sum(len(r.outputs) != r.expected for r in ok)
+
+    corrupt = leftovers = 0
+    for name in os.listdir(cache_dir):
+        folder = os.path.join(cache_dir, name)
+        if not os.path.isdir(folder):
+            continue
+        leftovers += sum(f.endswith(".tmp") for f in os.listdir(folder))
+        path = os.path.join(folder, DETECTIONS_FILE)
+        if os.path.exists(path):
+            try:
+                with open(path, "rb") as fh:
+                    unpack_detections(fh.read())
+            except (ValueError, struct.error):
+                corrupt += 1
+
+    checks = {"inconsistent_inputs": inconsistent, "foreign_outputs": foreign, "incomplete": incomplete,
+              "corrupt_cache_entries": corrupt, "tmp_leftovers": leftovers,
+              "failed": len(results) - len(ok)}
+    checks["errors"] = sum(checks.values())
+    print("\nСтресс-тест: " + ("OK" if not checks["errors"] else "ОШИБКИ"))
+    for name, value in checks.items():
+        if name != "errors":
+            print(f"  {name:<24} {value}")
+    return checks
+
+
+# --- Запуск -----------------------------------------------------------------------
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на фейковом Telegram Bot API")
+    parser.add_argument("--users", type=int, default=4, help="число одновременных пользователей")
+    parser.add_argument("--photos", type=int, default=5, help="фото на пользователя")
+    parser.add_argument("--mode", choices=("fast", "pro"), default="fast")
+    parser.add_argument("--images", default=str(Path(__file__).resolve().parent / "IMG_test"))
+    parser.add_argument("--work-dir", help="папка весов (WORK_DIR бота)")
+    parser.add_argument("--weights", help="файл весов (по умолчанию — DEFAULT_WEIGHTS бота)")
+    parser.add_argument("--cascade-weights", help="лёгкие веса каскада fast (\"\" — без каскада)")
+    parser.add_argument("--format", choices=("auto", "pt", "onnx", "openvino", "int8"),
+                        help="INFERENCE_FORMAT бота (по умолчанию — его собственный)")
+    parser.add_argument("--cache-dir", help="папка кеша; по умолчанию — временная (холодный кеш)")
+    parser.add_argument("--unique", action="store_true", help="каждое фото — новые байты (точный кеш не срабатывает)")
+    parser.add_argument("--no-near-dup", action="store_true", help="отключить поиск почти-дубликатов")
+    parser.add_argument("--think-ms", type=float, default=0, help="пауза пользователя между фото")
+    parser.add_argument("--request-timeout", type=float, default=300)
+    parser.add_argument("--port", type=int, default=18081, help="порт фейкового Bot API")
+    parser.add_argument("--json", help="сохранить сводку в JSON")
+    parser.add_argument("--stress", action="store_true",
+                        help="стресс-тест параллельности: одинаковые фото от всех пользователей одновременно + проверки")
+    parser.add_argument("--stress-images", type=int, default=2, help="сколько разных фото в стресс-тесте")
+    parser.add_argument("--metrics", help="сохранить метрики бота (формат Prometheus) после прогона")
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace) -> dict:
+    api = FakeBotAPI()
+    runner = web.AppRunner(api.build_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    # Бот читает настройки из окружения при импорте
+    os.environ["TOKEN"] = BOT_TOKEN
+    os.environ["TELEGRAM_API_BASE_URL"] = f"http://127.0.0.1:{args.port}"
+    cache_dir = os.environ["CACHE_DIR"] = args.cache_dir or tempfile.mkdtemp(prefix="bench_cache_")
+    if args.work_dir:
+        os.environ["WORK_DIR"] = args.work_dir
+    if args.weights:
+        os.environ["YOLO_WEIGHTS"] = args.weights
+    if args.cascade_weights is not None:
+        os.environ["YOLO_CASCADE_WEIGHTS"] = args.cascade_weights
+    if args.format:
+        os.environ["INFERENCE_FORMAT"] = args.format
+    import KhiminArtemAI_03 as bot
+
+    application = bot.build_application()  # заодно поднимает модели, пул и сервис детекции (bot.detector)
+    user_ids = list(range(1001, 1001 + args.users))
+    if args.mode == "pro":
+        bot.ADMIN_USER_IDS = set(bot.ADMIN_USER_IDS) | set(user_ids)  # pro доступен только админам
+    if args.no_near_dup:
+        bot.detector.phash_index = None
+
+    # Фото, дошедшие до инференса (одиночные и из альбомов; каскад из двух моделей — одно фото)
+    inferred_before = INFERRED.value(mode=args.mode)
+
+    images = load_images(args.images)
+    if args.stress:
+        images = images[:args.stress_images]
+    results: List[Request] = []
+    async with application:
+        await application.start()
+        await application.updater.start_polling(poll_interval=0.0, timeout=10)
+        if args.mode == "pro":
+            for user_id in user_ids:
+                api.send_text(user_id, "/pro")
+        started = time.perf_counter()
+        await asyncio.gather(*(run_user(api, uid, images, args, results) for uid in user_ids))
+        wall = time.perf_counter() - started
+        await application.updater.stop()
+        await application.stop()
+    await runner.cleanup()
+
+    inferences = int(INFERRED.value(mode=args.mode) - inferred_before)
+    summary = report(results, wall, bot, api, inferences)
+    if args.stress:
+        summary["stress"] = check_isolation(results, cache_dir)
+    if args.metrics:  # те же гистограммы стадий, что отдаёт /metrics
+        with open(args.metrics, "w", encoding="utf-8") as fh:
+            fh.write(REGISTRY.render())
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(summary, fh, ensure_ascii=False, indent=2)
+    return summary
+
+
+if __name__ == "__main__":
+    result = asyncio.run(main(parse_args()))
+    sys.exit(1 if result.get("stress", {}).get("errors") else 0)
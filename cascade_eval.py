@@ -0,0 +1,132 @@
+"""Оценка каскада fast-режима: точность и задержка лёгкая -> тяжёлая модель на локальной папке картинок.
+
+Каждая картинка прогоняется обеими моделями (forward + NMS при conf = CONF_FLOOR, как в боте), затем
+для сетки порогов CascadePolicy считается, какие картинки ушли бы на эскалацию. Эталон — ответ тяжёлой
+модели (conf >= --conf): разметка не нужна, точность каскада = насколько он совпадает с yolov5x.
+
+Пример:
+    python cascade_eval.py --images IMG_test --work-dir D:/UII/DataScience/16_OD/OD --small yolov5s.pt --large yolov5x.pt
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+from pathlib import Path
+from typing import Dict, List
+
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+# порог кеша, фильтр «что видит пользователь» и список расширений — те же, что у бота
+from yolo_engine import CONF_FLOOR, IMAGE_EXTS, CascadePolicy, ModelRegistry, select_detections  # noqa: E402
+from utils.metrics import box_iou  # noqa: E402  yolov5/utils (папка yolov5 в sys.path через yolo_engine)
+
+MATCH_IOU = 0.5    # бокс каскада совпал с эталонным: тот же класс и IoU >= MATCH_IOU
+
+
+def match(pred: np.ndarray, ref: np.ndarray) -> int:
+    """Жадное сопоставление по убыванию conf -> число совпавших боксов (TP)."""
+    if not len(pred) or not len(ref):
+        return 0
+    ious = box_iou(torch.from_numpy(pred[:, :4]), torch.from_numpy(ref[:, :4])).numpy()
+    ious[pred[:, 5][:, None] != ref[:, 5][None, :]] = 0  # другой класс не считается
+    used = np.zeros(len(ref), dtype=bool)
+    tp = 0
+    for i in np.argsort(-pred[:, 4]):
+        candidates = np.where(~used & (ious[i] >= MATCH_IOU))[0]
+        if len(candidates):
+            used[candidates[np.argmax(ious[i, candidates])]] = True
+            tp += 1
+    return tp
+
+
+def run_model(registry: ModelRegistry, weights_path: str, images: List[np.ndarray], iou: float) -> tuple:
+    model = registry.get(weights_path)  # загрузка + прогрев не входят в замер
+    dets, times = [], []
+    for im0 in images:
+        started = time.perf_counter()
+        det = model.detect(im0, CONF_FLOOR, iou)
+        times.append(time.perf_counter() - started)
+        dets.append(det.cpu().numpy().astype(np.float32))
+    return dets, times
+
+
+def scores(chosen: List[np.ndarray], refs: List[np.ndarray]) -> Dict[str, float]:
+    tp = sum(match(p, r) for p, r in zip(chosen, refs))
+    n_pred = sum(len(p) for p in chosen)
+    n_ref = sum(len(r) for r in refs)
+    precision = tp / n_pred if n_pred else 1.0
+    recall = tp / n_ref if n_ref else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"precision": precision, "recall": recall, "f1": f1}
+
+
+def evaluate(args: argparse.Namespace) -> dict:
+    paths = [p for p in sorted(Path(args.images).iterdir()) if p.suffix.lower() in IMAGE_EXTS]
+    images = [im for im in (cv2.imread(str(p)) for p in paths) if im is not None]
+    if not images:
+        raise SystemExit(f"В {args.images} нет изображений")
+    classes = [int(c) for c in args.classes.split()] if args.classes else None
+
+    registry = ModelRegistry(device=args.device)
+    small, t_small = run_model(registry, os.path.join(args.work_dir, args.small), images, args.iou)
+    large, t_large = run_model(registry, os.path.join(args.work_dir, args.large), images, args.iou)
+    refs = [select_detections(d, args.conf, classes) for d in large]
+    small_vis = [select_detections(d, args.conf, classes) for d in small]
+    mean_large = float(np.mean(t_large))
+
+    rows = [
+        {"policy": f"только {args.small}", "escalated": 0.0, "latency_ms": float(np.mean(t_small)) * 1000,
+         **scores(small_vis, refs)},
+        {"policy": f"только {args.large}", "escalated": 1.0, "latency_ms": mean_large * 1000,
+         **scores(refs, refs)},
+    ]
+    for low, max_uncertain, if_empty in itertools.product(args.band_low, args.max_uncertain, (True, False)):
+        policy = CascadePolicy(conf=args.conf, band=(low, args.conf), max_uncertain=max_uncertain,
+                               escalate_if_empty=if_empty)
+        escalate = [policy.escalate(d, classes) is not None for d in small]
+        chosen = [r if e else s for e, r, s in zip(escalate, refs, small_vis)]
+        latency = [ts + (tl if e else 0.0) for e, ts, tl in zip(escalate, t_small, t_large)]
+        rows.append({"policy": f"band=[{low:g},{args.conf:g}) max={max_uncertain} empty={'да' if if_empty else 'нет'}",
+                     "band_low": low, "max_uncertain": max_uncertain, "escalate_if_empty": if_empty,
+                     "escalated": float(np.mean(escalate)), "latency_ms": float(np.mean(latency)) * 1000,
+                     **scores(chosen, refs)})
+
+    print(f"\nКартинок: {len(images)}, эталон — {args.large} при conf >= {args.conf:g}"
+          f"{'' if classes is None else f', классы {classes}'}")
+    print(f"{'политика':<36} {'эскалаций':>9} {'мс/фото':>8} {'ускор.':>6} {'P':>6} {'R':>6} {'F1':>6}")
+    for row in sorted(rows, key=lambda r: r["latency_ms"]):
+        speedup = mean_large * 1000 / row["latency_ms"] if row["latency_ms"] else float("nan")
+        print(f"{row['policy']:<36} {row['escalated']:>9.0%} {row['latency_ms']:>8.1f} {speedup:>6.2f}"
+              f" {row['precision']:>6.3f} {row['recall']:>6.3f} {row['f1']:>6.3f}")
+    return {"images": len(images), "small": args.small, "large": args.large, "rows": rows}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Точность/задержка каскада лёгкая -> тяжёлая модель")
+    parser.add_argument("--images", default=str(Path(__file__).resolve().parent / "IMG_test"))
+    parser.add_argument("--work-dir", default=".", help="папка весов (WORK_DIR бота)")
+    parser.add_argument("--small", default="yolov5s.pt", help="веса первого прохода")
+    parser.add_argument("--large", default="yolov5x.pt", help="веса эскалации (эталон)")
+    parser.add_argument("--conf", type=float, default=0.5, help="conf, с которым пользователь видит боксы")
+    parser.add_argument("--iou", type=float, default=0.45)
+    parser.add_argument("--classes", help='индексы классов COCO через пробел ("0" — люди); по умолчанию все')
+    parser.add_argument("--band-low", type=float, nargs="+", default=[0.1, 0.25, 0.35],
+                        help="нижние границы «сомнительного» интервала conf")
+    parser.add_argument("--max-uncertain", type=int, nargs="+", default=[0, 1, 2, 4, 8])
+    parser.add_argument("--device", default="", help='"" — авто, "cpu", "0"')
+    parser.add_argument("--json", help="сохранить таблицу в JSON")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    summary = evaluate(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(summary, fh, ensure_ascii=False, indent=2)
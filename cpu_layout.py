@@ -0,0 +1,93 @@
+"""Раскладка инференса по ядрам CPU: сколько forward идут одновременно, сколько потоков PyTorch у каждого и на каких ядрах.
+
+Без настройки каждый forward берёт torch.get_num_threads() == все ядра, и N одновременных forward запускают
+N x ядер потоков — они вытесняют друг друга и чужие кеши. Так и в бэкенде process (N процессов), и в thread:
+батчер ведёт один forward на файл весов за раз, но у каскада файлов два, и их forward идут параллельно.
+Раскладка делит ядра: workers одновременных forward по threads потоков intra-op. В process каждый процесс
+ещё и закрепляется за своими ядрами (только Linux); в thread потоки общие на процесс, закрепления нет,
+а число одновременных forward бэкенд ограничивает сам.
+Лучшую раскладку для конкретной машины и бэкенда подбирает tune_threads.py и сохраняет в JSON.
+"""
+
+import os
+import json
+import logging
+import platform
+from dataclasses import asdict, dataclass
+from typing import List, Optional, Sequence
+
+import torch
+
+from result_cache import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+def available_cpus() -> List[int]:
+    """Ядра, доступные процессу (с учётом taskset/cgroup на Linux)."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+@dataclass(frozen=True)
+class ThreadLayout:
+    """workers одновременных forward по threads потоков; pin — каждому процессу-воркеру свои ядра (process)."""
+    workers: int = 2
+    threads: int = 1
+    interop: int = 1  # inter-op параллелизм не нужен: граф YOLO — последовательность свёрток
+    pin: bool = True
+
+    @classmethod
+    def default(cls, workers: int) -> "ThreadLayout":
+        """Без замеров: ядра поровну между одновременными forward."""
+        return cls(workers=workers, threads=max(1, len(available_cpus()) // workers))
+
+    def core_sets(self, cpus: Optional[Sequence[int]] = None) -> List[Optional[List[int]]]:
+        """Ядра каждого воркера подряд (соседние ядра делят кеш); ядер не хватает — без закрепления."""
+        cpus = list(cpus if cpus is not None else available_cpus())
+        if not self.pin or self.workers * self.threads > len(cpus):
+            return [None] * self.workers
+        return [cpus[i * self.threads:(i + 1) * self.threads] for i in range(self.workers)]
+
+
+def apply_threads(threads: int, interop: int) -> None:
+    """Потоки PyTorch текущего процесса: до первого forward (inter-op задаётся один раз за процесс)."""
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(interop)
+    except RuntimeError:  # inter-op пул уже запущен — остаётся прежний размер
+        logger.debug("inter-op потоки уже заданы: %d", torch.get_num_interop_threads())
+
+
+def pin_process(cores: Optional[Sequence[int]]) -> None:
+    """Закрепляет текущий процесс (и потоки, которые он создаст) за ядрами cores."""
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+
+def host_signature() -> dict:
+    """По чему видно, что раскладка подбиралась на этой машине."""
+    return {"cpus": len(available_cpus()), "machine": platform.machine(),
+            "processor": platform.processor(), "torch": torch.__version__}
+
+
+def load_layout(path: str, backend: str) -> Optional[ThreadLayout]:
+    """Сохранённая раскладка — если она для этой машины и этого бэкенда (иначе None)."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as fh:
+            data = json.load(fh)
+        if data["host"] != host_signature() or data["backend"] != backend:
+            logger.warning("Раскладка потоков %s подобрана для другой машины/бэкенда — не используем", path)
+            return None
+        return ThreadLayout(**data["layout"])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning("Раскладка потоков %s не прочитана: %s", path, e)
+        return None
+
+
+def save_layout(path: str, layout: ThreadLayout, backend: str, **extra) -> None:
+    data = {"host": host_signature(), "backend": backend, "layout": asdict(layout), **extra}
+    atomic_write(path, json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8"))
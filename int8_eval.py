@@ -0,0 +1,89 @@
+"""Потеря точности INT8 относительно FP32: val.py из yolov5 на локальном датасете для обеих моделей.
+
+INT8-артефакт берётся из кеша экспорта бота (или создаётся с калибровкой по --calib), затем
+val.py считает P, R, mAP@0.5 и mAP@0.5:0.95 для .pt и для INT8 на одной и той же выборке.
+Датасет — yaml в формате yolov5 (path/val/names), картинки и разметка должны лежать локально.
+
+Пример:
+    python int8_eval.py --data D:/datasets/coco128.yaml --work-dir D:/UII/DataScience/16_OD/OD --weights yolov5x.pt
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from model_export import artifact_folder, available_formats, prepare_runtime, read_meta  # noqa: E402
+from val import run as yolo_val  # noqa: E402  yolov5/val.py (папка yolov5 в sys.path через yolo_engine)
+
+METRICS = ("precision", "recall", "map50", "map")
+
+
+def validate(weights: str, args: argparse.Namespace, project: str, name: str) -> dict:
+    # task="speed": квадратный letterbox без rect-батчей и для .pt — INT8-граф трассирован под imgsz x imgsz,
+    # и обе модели видят одинаковые входы
+    (p, r, map50, map_, *_), _, times = yolo_val(data=args.data, weights=weights, batch_size=args.batch,
+                                                 imgsz=args.imgsz, device="cpu", workers=args.workers,
+                                                 task="speed", half=False, plots=False,
+                                                 project=project, name=name, exist_ok=True)
+    return {"precision": float(p), "recall": float(r), "map50": float(map50), "map": float(map_),
+            "inference_ms": float(times[1]), "nms_ms": float(times[2])}
+
+
+def evaluate(args: argparse.Namespace) -> dict:
+    weights = os.path.join(args.work_dir, args.weights)
+    imgsz = (args.imgsz, args.imgsz)
+    export_dir = args.export_dir or os.path.join(args.work_dir, "exported")
+    if "int8" not in available_formats():
+        raise SystemExit("В этой сборке PyTorch нет квантованных ядер x86/fbgemm")
+    prepare_runtime(weights, "int8", imgsz, args.batch, export_dir, sample_dir=args.calib, calib_dir=args.calib)
+    folder = artifact_folder(weights, "int8", imgsz, args.batch, export_dir, args.calib)
+    meta = read_meta(folder)
+    if meta is None:
+        raise SystemExit("INT8-экспорт не удался — подробности в логе выше")
+    # артефакт, не прошедший самопроверку, бот не грузит, но отчёт по нему всё равно нужен
+    artifact = os.path.join(folder, meta["artifact"])
+
+    with tempfile.TemporaryDirectory(prefix="int8_eval_") as project:
+        fp32 = validate(weights, args, project, "fp32")
+        int8 = validate(artifact, args, project, "int8")
+
+    delta = {k: int8[k] - fp32[k] for k in METRICS}
+    speedup = fp32["inference_ms"] / int8["inference_ms"] if int8["inference_ms"] else float("nan")
+    print(f"\nДатасет: {args.data}, веса: {args.weights}, imgsz={args.imgsz}, batch={args.batch}")
+    print(f"INT8: {artifact} (самопроверка: {'пройдена' if meta['check']['passed'] else 'НЕ пройдена'},"
+          f" совпадение детекций {meta['check'].get('agreement', float('nan')):.3f})")
+    print(f"{'модель':<8} {'P':>7} {'R':>7} {'mAP50':>7} {'mAP':>7} {'мс/фото':>8}")
+    for label, row in (("FP32", fp32), ("INT8", int8)):
+        print(f"{label:<8} {row['precision']:>7.4f} {row['recall']:>7.4f} {row['map50']:>7.4f} {row['map']:>7.4f}"
+              f" {row['inference_ms']:>8.1f}")
+    print(f"{'Δ':<8} {delta['precision']:>+7.4f} {delta['recall']:>+7.4f} {delta['map50']:>+7.4f}"
+          f" {delta['map']:>+7.4f} {speedup:>7.2f}x")
+    return {"data": args.data, "weights": args.weights, "artifact": artifact, "check": meta["check"],
+            "fp32": fp32, "int8": int8, "delta": delta, "speedup": speedup}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="mAP и скорость INT8 против FP32 (val.py на локальном датасете)")
+    parser.add_argument("--data", required=True, help="yaml датасета в формате yolov5 (картинки и разметка локально)")
+    parser.add_argument("--work-dir", default=".", help="папка весов (WORK_DIR бота)")
+    parser.add_argument("--weights", default="yolov5x.pt")
+    parser.add_argument("--calib", default=str(Path(__file__).resolve().parent / "IMG_test"),
+                        help="папка картинок для калибровки INT8 (как INT8_CALIB_DIR бота)")
+    parser.add_argument("--export-dir", help="кеш артефактов; по умолчанию WORK_DIR/exported, как у бота")
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--batch", type=int, default=10, help="как BATCH_MAX_SIZE бота (входит в ключ артефакта)")
+    parser.add_argument("--workers", type=int, default=2, help="потоков загрузчика данных val.py")
+    parser.add_argument("--json", help="сохранить отчёт в JSON")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    summary = evaluate(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(summary, fh, ensure_ascii=False, indent=2)
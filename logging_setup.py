@@ -0,0 +1,180 @@
+"""Логирование вне event loop: очередь -> поток записи, JSON-записи с request_id, сэмплирование, маскирование секретов.
+
+Хендлеры с вводом-выводом (файл с ротацией, консоль) работают в потоке QueueListener;
+в потоке вызова остаётся только форматирование сообщения и put в очередь.
+"""
+
+import re
+import copy
+import json
+import queue
+import atexit
+import secrets
+import logging
+import threading
+import contextvars
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Iterable, Optional
+
+TEXT_FORMAT = "%(asctime)s | %(levelname)s | %(name)s | %(message)s"  # прежний формат (консоль)
+
+# Токен в URL Bot API: https://api.telegram.org/bot<id>:<секрет>/getUpdates
+TOKEN_RE = re.compile(r"bot\d+:[A-Za-z0-9_-]{20,}")
+
+# --- Контекст запроса ---------------------------------------------------------
+# Задачи asyncio наследуют контекст: request_id и словарь стадий видны и в дочерних задачах запроса
+REQUEST_ID: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+_STAGES: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("stages", default=None)
+
+
+def start_request(request_id: Optional[str] = None) -> str:
+    """Начинает запрос в текущем контексте: новый request_id и пустые тайминги стадий."""
+    request_id = request_id or secrets.token_hex(4)
+    REQUEST_ID.set(request_id)
+    _STAGES.set({})
+    return request_id
+
+
+def add_stage(stage: str, seconds: float) -> None:
+    """Добавляет длительность стадии к текущему запросу (стадия может повторяться — время суммируется)."""
+    stages = _STAGES.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+def request_stages() -> Dict[str, float]:
+    """Копия таймингов текущего запроса, секунды (округлены до 0.1 мс)."""
+    return {k: round(v, 4) for k, v in (_STAGES.get() or {}).items()}
+
+
+# --- Фильтры (в потоке вызова, до очереди) ------------------------------------
+class RequestContextFilter(logging.Filter):
+    """Проставляет request_id из contextvars: в потоке QueueListener контекста запроса уже нет."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = REQUEST_ID.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает 1 из N рутинных записей (ниже WARNING) от шумных логгеров; предупреждения и ошибки — все."""
+
+    def __init__(self, every: Dict[str, int]) -> None:
+        super().__init__()
+        self.every = dict(every)  # имя логгера (вместе с дочерними) -> N
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()  # пишут и потоки пула инференса
+
+    def _rate(self, name: str) -> int:
+        for prefix, n in self.every.items():
+            if name == prefix or name.startswith(prefix + "."):
+                return n
+        return 1
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        n = self._rate(record.name)
+        if n <= 1:
+            return True
+        with self._lock:
+            seen = self._counts.get(record.name, 0)
+            self._counts[record.name] = seen + 1
+        record.sample_rate = n  # в JSON видно, что строка — одна из N
+        return seen % n == 0
+
+
+class RedactingQueueHandler(QueueHandler):
+    """QueueHandler, который до постановки в очередь собирает сообщение и traceback и вычищает из них секреты."""
+
+    def __init__(self, log_queue: queue.SimpleQueue, secret_values: Iterable[Optional[str]] = ()) -> None:
+        super().__init__(log_queue)
+        self.secret_values = [s for s in secret_values if s]
+        self._exc_formatter = logging.Formatter()
+
+    def redact(self, text: str) -> str:
+        text = TOKEN_RE.sub("bot<TOKEN>", text)
+        for value in self.secret_values:
+            text = text.replace(value, "***")
+        return text
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Аргументы сообщения могут измениться после возврата из logger.info — собираем строку сейчас
+        record = copy.copy(record)
+        record.msg = record.message = self.redact(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None  # traceback с кадрами не отправляем в другой поток
+        if record.exc_text:
+            record.exc_text = self.redact(record.exc_text)
+        if record.stack_info:
+            record.stack_info = self.redact(record.stack_info)
+        return record
+
+
+# --- Форматирование (в потоке QueueListener) ---------------------------------
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "request_id"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна JSON-строка; поля из extra={...} попадают в запись как есть."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            data["request_id"] = request_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        if record.stack_info:
+            data["stack"] = record.stack_info
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _Listener(QueueListener):
+    def stop(self) -> None:
+        if self._thread is not None:  # повторная остановка (atexit после явного stop) — без ошибки
+            super().stop()
+
+
+def setup_logging(log_file: str = "model.log",
+                  level: int = logging.INFO,
+                  max_bytes: int = 2 * 1024 * 1024,
+                  backup_count: int = 5,
+                  json_file: bool = True,
+                  sample_every: Optional[Dict[str, int]] = None,
+                  secret_values: Iterable[Optional[str]] = ()) -> QueueListener:
+    """Заменяет хендлеры root-логгера одним QueueHandler; файл и консоль пишет поток QueueListener.
+
+    Очередь не ограничена: при медленном диске растёт память, но запрос не ждёт записи лога.
+    """
+    file_handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    file_handler.setFormatter(JsonFormatter() if json_file else logging.Formatter(TEXT_FORMAT))
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = RedactingQueueHandler(log_queue, secret_values)
+    queue_handler.addFilter(SamplingFilter(sample_every or {}))  # отброшенное не стоит даже форматирования
+    queue_handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = _Listener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # дописываем очередь до конца при выходе
+    return listener
@@ -0,0 +1,226 @@
+"""Метрики бота в формате Prometheus: гистограммы стадий, счётчики и HTTP-эндпоинт /metrics.
+
+Без внешних зависимостей: текстовый формат экспозиции Prometheus 0.0.4 собирается вручную.
+"""
+
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"  # то, что ждёт Prometheus при опросе
+
+# Границы корзин (секунды): от миллисекундных попаданий в кеш до тайм-аута задачи
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 180.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    """Без потери точности: целые — без дробной части, остальные — repr (как в prometheus_client)."""
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()  # наблюдения приходят и из потоков пула инференса
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Монотонный счётчик событий."""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_labels_text(self.labelnames, k)} {_number(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    """Гистограмма длительностей с фиксированными корзинами (как prometheus_client.Histogram)."""
+    kind = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], list] = {}  # метки -> [счётчики корзин, сумма, количество]
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self, **labels: str) -> Tuple[List[int], float, int]:
+        """Счётчики корзин, сумма и число наблюдений серии (нули, если наблюдений не было)."""
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            return ([*series[0]], series[1], series[2]) if series else ([0] * len(self.buckets), 0.0, 0)
+
+    def quantile(self, q: float, **labels: str) -> float:
+        """Квантиль q (0..1) по корзинам: линейно внутри корзины, как histogram_quantile в Prometheus."""
+        counts, _, count = self.snapshot(**labels)
+        if not count:
+            return float("nan")
+        rank = q * count
+        cumulative, lower = 0, 0.0
+        for bound, n in zip(self.buckets, counts):
+            if n and cumulative + n >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / n
+            cumulative += n
+            lower = bound
+        return self.buckets[-1]  # квантиль попал в корзину +Inf — верхняя конечная граница
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Замер блока кода (в т.ч. с await внутри) — наблюдение записывается и при исключении."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._series.items())
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = 'le="%g"' % bound
+                lines.append(f"{self.name}_bucket{_labels_text(self.labelnames, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels_text(self.labelnames, key, le)} {count}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labelnames, key)} {total:.6f}")
+            lines.append(f"{self.name}_count{_labels_text(self.labelnames, key)} {count}")
+        return lines
+
+
+class GaugeFunc(_Metric):
+    """Значение, снимаемое в момент опроса (длина очереди, занятая память кеша)."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, func: Callable[[], float]) -> None:
+        super().__init__(name, documentation)
+        self.func = func
+
+    def collect(self) -> List[str]:
+        try:
+            value = float(self.func())
+        except Exception:  # опрос метрик не должен падать из-за одного источника
+            return []
+        return self.header() + [f"{self.name} {_number(value)}"]
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Метрики бота ------------------------------------------------------------------
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "bot_stage_seconds", "Длительность стадий обработки фото", ["stage"]))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "bot_request_seconds", "Полное время обработки фото: от получения обновления до отправки результатов", ["mode"]))
+REQUESTS = REGISTRY.register(Counter(
+    "bot_requests_total", "Фото, принятые в обработку, по режиму", ["mode"]))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "bot_cache_lookups_total", "Обращения к уровням кеша", ["tier", "result"]))
+TIMEOUTS = REGISTRY.register(Counter(
+    "bot_timeouts_total", "Задачи, прерванные по тайм-ауту инференса", ["mode"]))
+REJECTIONS = REGISTRY.register(Counter(
+    "bot_rejections_total", "Фото, отклонённые без обработки", ["reason"]))
+INFERRED = REGISTRY.register(Counter(
+    "bot_inferred_photos_total", "Фото, которые дошли до инференса (не нашлись ни в одном кеше), по режиму", ["mode"]))
+CASCADE = REGISTRY.register(Counter(
+    "bot_cascade_total", "Решения каскада fast: accepted — ответ лёгкой модели, иначе причина эскалации", ["result"]))
+ERRORS = REGISTRY.register(Counter(
+    "bot_errors_total", "Ошибки обработки фото", ["stage"]))
+
+
+def register_gauge(name: str, documentation: str, func: Callable[[], float]) -> None:
+    REGISTRY.register(GaugeFunc(name, documentation, func))
+
+
+# --- HTTP-эндпоинт -----------------------------------------------------------------
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=REGISTRY.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+
+def add_metrics_route(app: web.Application, path: str = "/metrics") -> None:
+    """Добавляет /metrics в уже существующее aiohttp-приложение (например, сервер вебхука)."""
+    app.router.add_get(path, _handle_metrics)
+
+
+async def start_metrics_server(listen: str, port: int) -> Optional[web.AppRunner]:
+    """Отдельный HTTP-сервер метрик (режим polling); port=0 — выключено."""
+    if not port:
+        return None
+    app = web.Application()
+    add_metrics_route(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, listen, port).start()
+    logger.info("Метрики: http://%s:%d/metrics", listen, port)
+    return runner
@@ -0,0 +1,320 @@
+"""Экспорт весов в быстрый CPU-формат (OpenVINO / ONNX Runtime / INT8 TorchScript) при первом запуске и кеш артефактов.
+
+Артефакт лежит в <export_dir>/<ключ>/, где ключ — хеш весов, imgsz, батч, формат и версии библиотек:
+после обновления весов, torch или рантайма экспорт выполняется заново. Перед использованием артефакт
+сверяется с PyTorch на тех же картинках; вердикт сохраняется в meta.json (в т.ч. отрицательный —
+неудачный экспорт не повторяется на каждом старте).
+
+INT8 — статическая post-training квантизация PyTorch (FX, бэкенд x86/fbgemm) с калибровкой по папке картинок;
+голова Detect остаётся во float. Результат сохраняется как TorchScript, его грузит тот же DetectMultiBackend.
+Потерю mAP относительно FP32 показывает int8_eval.py.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import importlib.util
+import warnings
+from importlib import metadata
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from yolo_engine import DEFAULT_IMGSZ, IMAGE_EXTS, YoloModel, decode_image
+from models.yolo import Detect  # noqa: E402  папка yolov5 уже в sys.path через yolo_engine
+from utils.metrics import box_iou  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# Форматы по убыванию скорости на CPU и что нужно каждому (модули для импорта, дистрибутивы для версий).
+# exact=False — формат с потерей точности: в "auto" не выбирается, самопроверка — по совпадению детекций
+FORMATS = {
+    "openvino": {"modules": ("onnx", "openvino"), "dists": ("onnx", "openvino", "openvino-dev"), "exact": True},
+    "onnx": {"modules": ("onnx", "onnxruntime"), "dists": ("onnx", "onnxruntime"), "exact": True},
+    "int8": {"modules": (), "dists": (), "exact": False},
+}
+INT8_ENGINES = ("x86", "fbgemm")  # квантованные ядра PyTorch для x86 CPU
+INT8_SUFFIX = "_int8.torchscript"
+META_FILE = "meta.json"
+BOX_TOL = 1.0     # самопроверка: расхождение координат сырых предсказаний, пикселей входа сети
+SCORE_TOL = 0.01  # самопроверка: расхождение objectness/вероятностей классов
+MIN_AGREEMENT = 0.8  # самопроверка INT8: доля совпавших детекций (conf >= CHECK_CONF, IoU >= 0.5, тот же класс)
+CHECK_CONF = 0.25
+CALIB_IMAGES = 64  # картинок для калибровки INT8 (больше — точнее диапазоны активаций, дольше первый старт)
+
+
+def _version(dist: str) -> Optional[str]:
+    try:
+        return metadata.version(dist)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def _int8_engine() -> Optional[str]:
+    supported = torch.backends.quantized.supported_engines
+    return next((engine for engine in INT8_ENGINES if engine in supported), None)
+
+
+def available_formats() -> List[str]:
+    """Форматы, для которых установлено всё нужное (без попыток доустановки через pip)."""
+    return [fmt for fmt, req in FORMATS.items()
+            if all(importlib.util.find_spec(m) is not None for m in req["modules"])
+            and all(_version(d) is not None for d in req["dists"])
+            and (fmt != "int8" or _int8_engine() is not None)]
+
+
+def library_versions(fmt: str) -> Dict[str, Optional[str]]:
+    versions = {"torch": torch.__version__}
+    versions.update({dist: _version(dist) for dist in FORMATS[fmt]["dists"]})
+    if fmt == "int8":
+        versions["engine"] = _int8_engine()
+    return versions
+
+
+def weights_hash(weights_path: str) -> str:
+    h = hashlib.sha256()
+    with open(weights_path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _image_paths(folder: Optional[str], limit: int) -> List[Path]:
+    if not folder or not os.path.isdir(folder):
+        return []
+    return [p for p in sorted(Path(folder).iterdir()) if p.suffix.lower() in IMAGE_EXTS][:limit]
+
+
+def artifact_key(weights_path: str,
+                 fmt: str,
+                 imgsz: Tuple[int, int],
+                 batch: int,
+                 calib_dir: Optional[str] = None) -> str:
+    """Имя папки артефакта: всё, от чего зависит результат экспорта (для INT8 — и набор калибровки)."""
+    data = {"weights": weights_hash(weights_path), "format": fmt, "imgsz": list(imgsz), "batch": batch,
+            "versions": library_versions(fmt)}
+    if fmt == "int8":
+        data["calib"] = [(p.name, p.stat().st_size) for p in _image_paths(calib_dir, CALIB_IMAGES)]
+    payload = json.dumps(data, sort_keys=True)
+    return f"{Path(weights_path).stem}_{fmt}_{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]}"
+
+
+class _Body(torch.nn.Module):
+    """DetectionModel без ветвлений forward(augment, profile, ...) — их не пройти символьной трассировкой FX."""
+
+    def __init__(self, model: torch.nn.Module) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.model._forward_once(x)
+
+
+def quantize_int8(weights_path: str, imgsz: Tuple[int, int], samples: List[np.ndarray], out_file: str) -> str:
+    """Статическая INT8-квантизация (свёртки backbone/neck) с калибровкой на samples -> TorchScript-файл."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    engine = _int8_engine()
+    torch.backends.quantized.engine = engine
+    yolo = YoloModel(weights_path, device="cpu", imgsz=imgsz)  # DetectMultiBackend уже слил Conv+BN
+    model = yolo.model.model.float().eval()
+    model.model[-1].export = True  # Detect отдаёт один тензор, как в export.py
+    ims = [yolo.preprocess(im0, auto=False) for im0 in samples]  # тот же letterbox, что в боте
+
+    # Detect (декодирование сетки и якорей) — во float и без трассировки: квантуются только свёртки
+    qconfig = get_default_qconfig_mapping(engine).set_object_type(Detect, None)
+    custom = PrepareCustomConfig().set_non_traceable_module_classes([Detect])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # torch.ao.quantization помечен deprecated, но в torch 2.x работает
+        prepared = prepare_fx(_Body(model).eval(), qconfig, (ims[0],), prepare_custom_config=custom)
+        # no_grad, а не inference_mode: Detect кеширует сетку, и трассировка ниже должна её использовать
+        with torch.no_grad():
+            for im in ims:  # наблюдатели собирают диапазоны активаций
+                prepared(im)
+            quantized = convert_fx(prepared)
+            traced = torch.jit.freeze(torch.jit.trace(quantized, ims[0], strict=False))
+    meta = {"shape": list(ims[0].shape), "stride": int(yolo.stride), "names": yolo.names}
+    torch.jit.save(traced, out_file, _extra_files={"config.txt": json.dumps(meta)})  # как export_torchscript
+    return out_file
+
+
+def export_artifact(weights_path: str,
+                    fmt: str,
+                    imgsz: Tuple[int, int],
+                    batch: int,
+                    folder: str,
+                    calib_dir: Optional[str] = None) -> str:
+    """export.py из yolov5 (или INT8-квантизация) во временную папку, затем переименование в folder -> путь."""
+    from export import run as yolo_export  # yolov5/export.py (папка yolov5 уже в sys.path через yolo_engine)
+
+    parent = os.path.dirname(folder)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix=".export_")
+    try:
+        local = os.path.join(tmp, os.path.basename(weights_path))
+        shutil.copy2(weights_path, local)  # export.py пишет результат рядом с весами
+        if fmt == "int8":
+            if not _image_paths(calib_dir, 1):
+                logger.warning("Нет картинок для калибровки INT8 (%s) — калибровка на шуме, точность упадёт", calib_dir)
+            files = [quantize_int8(local, imgsz, load_samples(calib_dir, CALIB_IMAGES),
+                                   os.path.join(tmp, Path(local).stem + INT8_SUFFIX))]
+        else:
+            files = yolo_export(weights=local, imgsz=list(imgsz), batch_size=batch, device="cpu", include=(fmt,),
+                                dynamic=batch > 1,  # микробатч переменного размера: динамическая ось batch
+                                simplify=False)
+        if not files:
+            raise RuntimeError(f"export.py не создал {fmt}")
+        artifact = os.path.basename(os.path.normpath(files[-1]))  # openvino: папка *_openvino_model, onnx: файл
+        os.remove(local)
+        os.replace(tmp, folder)  # параллельный старт увидит либо пустоту, либо готовую папку
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return os.path.join(folder, artifact)
+
+
+def load_samples(sample_dir: Optional[str], limit: int = 4) -> List[np.ndarray]:
+    """Картинки для самопроверки; без папки — детерминированный шум (сравниваются сырые выходы сети)."""
+    samples = []
+    for path in _image_paths(sample_dir, limit):
+        try:
+            samples.append(decode_image(path.read_bytes()))
+        except ValueError:
+            continue
+    if not samples:
+        samples = [np.random.default_rng(0).integers(0, 256, (480, 640, 3), dtype=np.uint8)]
+    return samples
+
+
+def _agreement(p_ref: torch.Tensor, p_exp: torch.Tensor, input_shape: Tuple[int, int]) -> float:
+    """2·TP / (детекций PyTorch + детекций артефакта) после NMS; обе пустые — полное совпадение."""
+    tp = total = 0
+    for ref, exp in zip(p_ref, p_exp):
+        d_ref = YoloModel.postprocess(ref[None], input_shape, input_shape, CHECK_CONF, 0.45)
+        d_exp = YoloModel.postprocess(exp[None], input_shape, input_shape, CHECK_CONF, 0.45)
+        total += len(d_ref) + len(d_exp)
+        if len(d_ref) and len(d_exp):
+            ious = box_iou(d_ref[:, :4], d_exp[:, :4])
+            ious[d_ref[:, 5][:, None] != d_exp[:, 5][None, :]] = 0
+            tp += int((ious >= 0.5).any(1).sum()) + int((ious >= 0.5).any(0).sum())
+    return tp / total if total else 1.0
+
+
+def self_check(weights_path: str,
+               artifact_path: str,
+               imgsz: Tuple[int, int],
+               batch: int,
+               samples: List[np.ndarray],
+               exact: bool = True) -> dict:
+    """Сравнивает предсказания артефакта и PyTorch на одном батче (размер до batch).
+
+    exact=True — сырые выходы сети в пределах BOX_TOL/SCORE_TOL; иначе (INT8) — совпадение детекций после NMS.
+    """
+    n = max(1, min(batch, 2))  # батч из двух картинок проверяет и динамическую ось
+    ims = (samples * n)[:max(n, min(len(samples), batch))]
+    reference = YoloModel(weights_path, device="cpu", imgsz=imgsz)
+    exported = YoloModel(artifact_path, device="cpu", imgsz=imgsz)
+    p_ref, input_shape = reference.forward_batch(ims)
+    p_exp, _ = exported.forward_batch(ims)
+    p_ref, p_exp = p_ref.float().cpu(), p_exp.float().cpu()
+    if p_ref.shape != p_exp.shape:
+        return {"passed": False, "error": f"форма выхода {tuple(p_exp.shape)} != {tuple(p_ref.shape)}"}
+    box_diff = float((p_ref[..., :4] - p_exp[..., :4]).abs().max())
+    score_diff = float((p_ref[..., 4:] - p_exp[..., 4:]).abs().max())
+    agreement = _agreement(p_ref, p_exp, input_shape)
+    passed = box_diff <= BOX_TOL and score_diff <= SCORE_TOL if exact else agreement >= MIN_AGREEMENT
+    return {"passed": passed, "images": len(ims), "max_box_diff": box_diff, "max_score_diff": score_diff,
+            "agreement": round(agreement, 4)}
+
+
+def artifact_folder(weights_path: str,
+                    fmt: str,
+                    imgsz: Tuple[int, int],
+                    batch: int,
+                    export_dir: Optional[str] = None,
+                    calib_dir: Optional[str] = None) -> str:
+    export_dir = export_dir or os.path.join(os.path.dirname(weights_path), "exported")
+    return os.path.join(export_dir, artifact_key(weights_path, fmt, imgsz, batch, calib_dir))
+
+
+def read_meta(folder: str) -> Optional[dict]:
+    """meta.json готового артефакта (None — экспорта ещё не было или он прервался)."""
+    meta_path = os.path.join(folder, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def prepare_runtime(weights_path: str,
+                    fmt: str = "auto",
+                    imgsz: Tuple[int, int] = DEFAULT_IMGSZ,
+                    batch: int = 1,
+                    export_dir: Optional[str] = None,
+                    sample_dir: Optional[str] = None,
+                    calib_dir: Optional[str] = None) -> str:
+    """Путь, который грузить вместо weights_path: проверенный артефакт или сами .pt-веса.
+
+    fmt: "auto" — самый быстрый доступный точный CPU-формат (на GPU остаётся PyTorch), "pt" — без экспорта,
+    "openvino" / "onnx" / "int8" — конкретный формат. Любая ошибка экспорта -> предупреждение и .pt.
+    calib_dir — картинки для калибровки INT8 (по умолчанию sample_dir).
+    """
+    if fmt == "pt" or not os.path.isfile(weights_path):
+        return weights_path
+    if fmt == "auto":
+        if torch.cuda.is_available():
+            return weights_path
+        candidates = [f for f in available_formats() if FORMATS[f]["exact"]]
+    elif fmt in available_formats():
+        candidates = [fmt]
+    else:  # иначе check_requirements из yolov5 полезет ставить пакеты через pip
+        logger.warning("Формат %s недоступен (нужны: %s) — инференс на PyTorch",
+                       fmt, ", ".join(FORMATS.get(fmt, {}).get("dists", ())) or "openvino / onnx / pt")
+        return weights_path
+    calib_dir = calib_dir or sample_dir
+
+    for candidate in candidates:
+        try:
+            folder = artifact_folder(weights_path, candidate, imgsz, batch, export_dir, calib_dir)
+            key = os.path.basename(folder)
+            meta = read_meta(folder)
+            if meta is not None:
+                if meta["check"]["passed"]:
+                    return os.path.join(folder, meta["artifact"])
+                logger.info("Артефакт %s не прошёл самопроверку ранее — пропускаем", key)
+                continue
+            if os.path.exists(folder):  # папка без meta.json — экспорт прервался; пересоздаём
+                shutil.rmtree(folder, ignore_errors=True)
+
+            logger.info("Экспорт %s -> %s (imgsz=%s, batch=%d)…", weights_path, candidate, imgsz, batch)
+            started = time.perf_counter()
+            artifact_path = export_artifact(weights_path, candidate, imgsz, batch, folder, calib_dir)
+            check = self_check(weights_path, artifact_path, imgsz, batch, load_samples(sample_dir),
+                               exact=FORMATS[candidate]["exact"])
+            meta = {"weights": os.path.basename(weights_path), "format": candidate, "imgsz": list(imgsz),
+                    "batch": batch, "versions": library_versions(candidate),
+                    "artifact": os.path.basename(artifact_path), "check": check,
+                    "export_sec": round(time.perf_counter() - started, 1)}
+            with open(os.path.join(folder, META_FILE), "w", encoding="utf-8") as fh:
+                json.dump(meta, fh, ensure_ascii=False, indent=2)
+            if check["passed"]:
+                logger.info("Экспорт готов: %s (самопроверка: %s)", artifact_path, check)
+                return artifact_path
+            logger.warning("Артефакт %s расходится с PyTorch (%s) — не используем", artifact_path, check)
+        except Exception as e:
+            logger.warning("Экспорт %s в %s не удался: %s", weights_path, candidate, e)
+    return weights_path
+
+
+def prepare_runtimes(weights_paths: Iterable[str], **kwargs) -> Dict[str, str]:
+    """{.pt: что загружать} только для весов, у которых есть проверенный артефакт."""
+    runtime = {path: prepare_runtime(path, **kwargs) for path in weights_paths}
+    return {path: target for path, target in runtime.items() if target != path}
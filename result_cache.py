@@ -0,0 +1,416 @@
+"""Кеш результатов детекции: персистентный индекс поверх папки cache/."""
+
+import os
+import re
+import json
+import time
+import shutil
+import struct
+import tempfile
+import sqlite3  # индекс живёт в одном файле рядом с кешем и переживает перезапуск бота
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DETECTIONS_FILE = "detections.ydt"  # единственный файл записи: детекции после NMS
+RESULT_EXTS = (".ydt",)  # какие файлы папки кеша считаем результатами (старые JPEG-записи удаляются)
+KEY_RE = re.compile(r"[0-9a-f]{64}")  # папка записи — sha256-ключ; прочие папки (CACHE_DIR=WORK_DIR) не трогаем
+
+
+# --- Компактный бинарный формат детекций ---------------------------------------
+# Заголовок: magic, h, w исходной картинки, число ячеек; далее по ячейке: IoU, число детекций
+# и записи DET_DTYPE (13 байт на бокс против ~100 КБ на отрисованный JPEG).
+_DET_MAGIC = b"YDT1"
+_DET_HEADER = struct.Struct("<4sIIH")
+_CELL_HEADER = struct.Struct("<fI")
+DET_DTYPE = np.dtype([("box", "<u2", (4,)), ("conf", "<f4"), ("cls", "u1")])
+
+
+def pack_detections(shape: Tuple[int, int], cells: Dict[float, np.ndarray]) -> bytes:
+    """{iou: детекции (n, 6) [xyxy, conf, cls]} -> байты. Координаты округляются до пикселя."""
+    h, w = shape
+    parts = [_DET_HEADER.pack(_DET_MAGIC, h, w, len(cells))]
+    for iou, det in sorted(cells.items()):
+        rec = np.empty(len(det), dtype=DET_DTYPE)
+        rec["box"] = np.clip(np.rint(det[:, :4]), 0, 65535)
+        rec["conf"] = det[:, 4]
+        rec["cls"] = det[:, 5]
+        parts.append(_CELL_HEADER.pack(iou, len(rec)))
+        parts.append(rec.tobytes())
+    return b"".join(parts)
+
+
+def unpack_detections(data: bytes) -> Tuple[Tuple[int, int], Dict[float, np.ndarray]]:
+    """Обратное к pack_detections: (h, w), {iou: детекции (n, 6) float32}."""
+    magic, h, w, n_cells = _DET_HEADER.unpack_from(data)
+    if magic != _DET_MAGIC:
+        raise ValueError("не файл детекций")
+    offset, cells = _DET_HEADER.size, {}
+    for _ in range(n_cells):
+        iou, n = _CELL_HEADER.unpack_from(data, offset)
+        offset += _CELL_HEADER.size
+        rec = np.frombuffer(data, dtype=DET_DTYPE, count=n, offset=offset)
+        offset += n * DET_DTYPE.itemsize
+        det = np.empty((n, 6), dtype=np.float32)
+        det[:, :4] = rec["box"]
+        det[:, 4] = rec["conf"]
+        det[:, 5] = rec["cls"]
+        cells[round(iou, 4)] = det  # float32 -> исходное значение порога (0.45, а не 0.4499…)
+    return (h, w), cells
+
+
+def atomic_write(path: str, data: bytes) -> None:
+    """Запись через временный файл в той же папке + os.replace: читатель видит старый или новый файл целиком.
+
+    Параллельные записи одного ключа не перемешиваются — побеждает последняя. На Windows os.replace
+    может получить PermissionError, пока файл открыт читателем, — это OSError, как и любая ошибка записи.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")  # .tmp не входит в RESULT_EXTS
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class CacheIndex:
+    """Персистентный LRU-индекс кеша: ключ -> файлы, размер, последний доступ и число попаданий.
+
+    Хранится в SQLite (index.sqlite3 в папке кеша). Поиск по первичному ключу и вытеснение
+    по индексу last_access — O(log n); счётчики занятого места и числа записей держим в памяти.
+    """
+
+    def __init__(self,
+                 cache_dir: str,
+                 max_items: int = 200,
+                 max_bytes: int = 512 * 1024 * 1024,
+                 db_name: str = "index.sqlite3") -> None:
+        self.cache_dir = cache_dir
+        self.max_items = max_items  # лимит по количеству записей
+        self.max_bytes = max_bytes  # лимит по суммарному размеру файлов
+        self._lock = threading.Lock()  # к индексу обращаются потоки пула инференса
+        self._db = sqlite3.connect(os.path.join(cache_dir, db_name), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")  # запись не блокирует чтение
+        # с WAL fsync только при checkpoint, а не на каждый commit (lookup пишет время доступа на каждом попадании);
+        # при сбое питания теряются последние commit, но не целостность базы — для кеша это допустимо
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY,"
+            " files TEXT NOT NULL,"          # JSON-список имён файлов внутри cache/<key>/
+            " size INTEGER NOT NULL,"        # суммарный размер файлов, байт
+            " last_access REAL NOT NULL,"    # время последнего обращения (unix)
+            " hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries(last_access)")
+        self._db.commit()
+        self.total_items = 0
+        self.total_bytes = 0
+        self.rebuild()
+
+    # ---------- Синхронизация с диском ----------
+    def rebuild(self) -> None:
+        """Сверяет индекс с папкой кеша: добавляет «осиротевшие» папки, удаляет записи без папок."""
+        with self._lock:
+            known = {key for (key,) in self._db.execute("SELECT key FROM entries")}
+            on_disk = {name for name in os.listdir(self.cache_dir)
+                       if KEY_RE.fullmatch(name) and os.path.isdir(os.path.join(self.cache_dir, name))}
+            for key in known - on_disk:  # папку удалили руками — убираем запись
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            for key in on_disk - known:  # папка осталась от прошлых запусков без индекса
+                folder = os.path.join(self.cache_dir, key)
+                files = sorted(f for f in os.listdir(folder) if f.lower().endswith(RESULT_EXTS))
+                if not files:
+                    shutil.rmtree(folder, ignore_errors=True)
+                    continue
+                size = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+                self._db.execute(
+                    "INSERT INTO entries (key, files, size, last_access, hits) VALUES (?, ?, ?, ?, 0)",
+                    (key, json.dumps(files), size, os.path.getmtime(folder)),
+                )
+            self.total_items, total_bytes = self._db.execute("SELECT COUNT(*), SUM(size) FROM entries").fetchone()
+            self.total_bytes = total_bytes or 0
+            self._evict_locked()
+            self._db.commit()
+        logger.info("Индекс кеша: %d записей, %.1f МБ", self.total_items, self.total_bytes / 2 ** 20)
+
+    # ---------- Операции ----------
+    def lookup(self, key: str) -> Optional[List[str]]:
+        """Пути к файлам записи (и отметка обращения) или None, если ключа нет."""
+        with self._lock:
+            row = self._db.execute("SELECT files FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?",
+                             (time.time(), key))
+            self._db.commit()
+        return [os.path.join(self.cache_dir, key, f) for f in json.loads(row[0])]
+
+    def add(self, key: str, files: List[str], size: int) -> None:
+        """Регистрирует записанную папку cache/<key>/ и вытесняет старое сверх лимитов."""
+        with self._lock:
+            old = self._db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self.total_items -= 1
+                self.total_bytes -= old[0]
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, files, size, last_access, hits) "
+                "VALUES (?, ?, ?, ?, COALESCE((SELECT hits FROM entries WHERE key = ?), 0))",
+                (key, json.dumps(files), size, time.time(), key),
+            )
+            self.total_items += 1
+            self.total_bytes += size
+            self._evict_locked()
+            self._db.commit()
+
+    def remove(self, key: str) -> None:
+        """Удаляет запись и её папку (например, если файлы повреждены)."""
+        with self._lock:
+            self._remove_locked(key)
+            self._db.commit()
+
+    # ---------- Вытеснение ----------
+    def _remove_locked(self, key: str) -> None:
+        row = self._db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.total_items -= 1
+            self.total_bytes -= row[0]
+        shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+
+    def _evict_locked(self) -> None:
+        """Удаляет самые давние записи, пока не уложимся и в число записей, и в объём."""
+        while self.total_items > self.max_items or (self.total_items and self.total_bytes > self.max_bytes):
+            row = self._db.execute("SELECT key FROM entries ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._remove_locked(row[0])
+
+
+@dataclass
+class CacheEntry:
+    """Отрисованный результат запроса: JPEG-байты и (после первой отправки) file_id фото в Telegram."""
+    key: str
+    images: List[bytes]
+    file_ids: Optional[List[str]] = None  # повторная отправка по file_id — без загрузки файла
+    nbytes: int = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.nbytes = sum(len(data) for data in self.images)
+
+
+class MemoryCache:
+    """Горячий уровень кеша в памяти (LRU по байтам) перед диском: попадание — без обращений к ФС."""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_entry_bytes: Optional[int] = None) -> None:
+        self.max_bytes = max_bytes  # общий лимит памяти под закодированные результаты
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 4  # слишком большие записи не держим
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)  # свежеиспользованная запись — в конец LRU
+            self.hits += 1
+            return entry
+
+    def put(self, entry: CacheEntry) -> None:
+        if entry.nbytes > self.max_entry_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(entry.key, None)
+            if old is not None:
+                self.total_bytes -= old.nbytes
+            self._entries[entry.key] = entry
+            self.total_bytes += entry.nbytes
+            while self.total_bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+
+    def set_file_ids(self, key: str, file_ids: List[str]) -> None:
+        """Запоминает file_id отправленных фото, чтобы следующие попадания не загружали файлы."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and len(file_ids) == len(entry.images):
+                entry.file_ids = list(file_ids)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "items": len(self._entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+class SentFileCache:
+    """Персистентная карта (file_unique_id входного фото + параметры) -> file_id отправленных результатов.
+
+    Повторное фото отвечается по file_id: без скачивания, без инференса и без загрузки результата.
+    """
+
+    def __init__(self, cache_dir: str, max_items: int = 10000, db_name: str = "sent_files.sqlite3") -> None:
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, db_name), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sent ("
+            " key TEXT PRIMARY KEY,"
+            " file_ids TEXT NOT NULL,"       # JSON-список file_id в порядке отправки
+            " last_access REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS sent_last_access ON sent(last_access)")
+        self._db.commit()
+        self.total_items = self._db.execute("SELECT COUNT(*) FROM sent").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[List[str]]:
+        with self._lock:
+            row = self._db.execute("SELECT file_ids FROM sent WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE sent SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, file_ids: List[str]) -> None:
+        with self._lock:
+            exists = self._db.execute("SELECT 1 FROM sent WHERE key = ?", (key,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO sent (key, file_ids, last_access) VALUES (?, ?, ?)",
+                             (key, json.dumps(file_ids), time.time()))
+            if exists is None:
+                self.total_items += 1
+            if self.total_items > self.max_items:  # вытесняем самые давние записи
+                excess = self.total_items - self.max_items
+                self._db.execute("DELETE FROM sent WHERE key IN "
+                                 "(SELECT key FROM sent ORDER BY last_access LIMIT ?)", (excess,))
+                self.total_items -= excess
+            self._db.commit()
+
+    def remove(self, key: str) -> None:
+        """Telegram больше не принимает эти file_id — забываем запись."""
+        with self._lock:
+            if self._db.execute("DELETE FROM sent WHERE key = ?", (key,)).rowcount:
+                self.total_items -= 1
+            self._db.commit()
+
+
+class BKTree:
+    """BK-дерево по расстоянию Хэмминга: поиск хешей в радиусе d без полного перебора."""
+
+    def __init__(self) -> None:
+        self._root: Optional[list] = None  # узел: [хеш, [payload, ...], {расстояние: дочерний узел}]
+        self.size = 0
+
+    def add(self, value: int, payload) -> None:
+        self.size += 1
+        if self._root is None:
+            self._root = [value, [payload], {}]
+            return
+        node = self._root
+        while True:
+            dist = bin(node[0] ^ value).count("1")
+            if dist == 0:
+                node[1].append(payload)
+                return
+            child = node[2].get(dist)
+            if child is None:
+                node[2][dist] = [value, [payload], {}]
+                return
+            node = child
+
+    def find(self, value: int, max_distance: int) -> List[Tuple[int, object]]:
+        """Все payload с расстоянием <= max_distance, ближайшие первыми."""
+        found, stack = [], [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            dist = bin(node[0] ^ value).count("1")
+            if dist <= max_distance:
+                found.extend((dist, payload) for payload in node[1])
+            for d, child in node[2].items():  # неравенство треугольника отсекает остальные ветки
+                if dist - max_distance <= d <= dist + max_distance:
+                    stack.append(child)
+        found.sort(key=lambda item: item[0])
+        return found
+
+
+class PHashIndex:
+    """Индекс почти-дубликатов: перцептивный хеш картинки -> ключи кеша (с теми же параметрами запроса).
+
+    Хеши хранятся в SQLite и при старте загружаются в BK-дерево. Строки, удалённые из таблицы сверх
+    max_items, из ответов find выкидываются сразу, а дерево перестраивается по таблице, когда мёртвых
+    узлов в нём становится больше живых. Записи, вытесненные из cache/, отфильтровываются при чтении
+    (вызывающий проверяет, что ключ ещё есть).
+    """
+
+    def __init__(self, cache_dir: str, max_items: int = 10000, db_name: str = "phash.sqlite3") -> None:
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, db_name), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS phash ("
+            " key TEXT PRIMARY KEY,"         # ключ записи в cache/
+            " params TEXT NOT NULL,"         # подпись параметров детекций (веса, классы)
+            " hash TEXT NOT NULL)"           # 64-битный хеш в hex (SQLite INTEGER — знаковый)
+        )
+        self._db.commit()
+        self._rebuild()
+
+    def _rebuild(self) -> None:
+        """BK-дерево и набор живых ключей — заново по таблице."""
+        self._tree = BKTree()
+        self._keys = set()
+        for key, params, value in self._db.execute("SELECT key, params, hash FROM phash"):
+            self._tree.add(int(value, 16), (params, key))
+            self._keys.add(key)
+
+    def add(self, value: int, params: str, key: str) -> None:
+        with self._lock:
+            inserted = self._db.execute("INSERT OR IGNORE INTO phash (key, params, hash) VALUES (?, ?, ?)",
+                                        (key, params, f"{value:016x}")).rowcount
+            if inserted:
+                self._tree.add(value, (params, key))
+                self._keys.add(key)
+                # таблица растёт только до max_items: старые строки (по rowid) удаляем
+                evicted = self._db.execute("SELECT key FROM phash WHERE rowid <= "
+                                           "(SELECT MAX(rowid) FROM phash) - ?", (self.max_items,)).fetchall()
+                if evicted:
+                    self._db.executemany("DELETE FROM phash WHERE key = ?", evicted)
+                    self._keys.difference_update(key for key, in evicted)
+            self._db.commit()
+            if self._tree.size > 2 * len(self._keys):
+                self._rebuild()
+
+    def find(self, value: int, params: str, max_distance: int) -> List[str]:
+        """Ключи кеша с теми же параметрами и хешем в радиусе max_distance, ближайшие первыми."""
+        with self._lock:
+            return [key for _, (p, key) in self._tree.find(value, max_distance)
+                    if p == params and key in self._keys]
@@ -0,0 +1,196 @@
+"""Подбор раскладки инференса по ядрам: замер одновременных forward x потоков PyTorch для бэкенда бота.
+
+Каждая раскладка меряется в свежих процессах (inter-op потоки задаются один раз за процесс, кеши не
+прогреты прошлой раскладкой), все forward идут одновременно на картинках из --images: прогрев, затем
+--seconds секунд замера, время каждого вызова — time.perf_counter, как в benchmarks.py/val.py.
+  --backend process: как в ProcessBackend — workers процессов, каждый закреплён за своими ядрами;
+  --backend thread:  как в ThreadBackend — один процесс, workers потоков с общими потоками PyTorch.
+    Батчер ведёт один forward на файл весов за раз, поэтому одновременных forward не больше, чем
+    файлов в --weights: для каскада передайте оба (--weights yolov5x.pt yolov5s.pt).
+В process i-й процесс считает --weights[i % len]; в thread потоки делят файлы весов, и поток с несколькими
+файлами чередует их, как батчер при ограничении одновременных forward. Лучшая раскладка пишется
+в WORK_DIR/thread_layout.json вместе с бэкендом, бот берёт её при старте с тем же INFERENCE_BACKEND.
+
+Пример:
+    python tune_threads.py --work-dir D:/UII/DataScience/16_OD/OD --weights yolov5x.pt yolov5s.pt --backend thread
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import threading
+import multiprocessing
+from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from cpu_layout import ThreadLayout, apply_threads, available_cpus, pin_process, save_layout  # noqa: E402
+from yolo_engine import IMAGE_EXTS, YoloModel, decode_image  # noqa: E402
+
+WARMUP_CALLS = 2
+
+
+def _load_batch(images: str, batch: int) -> List[np.ndarray]:
+    paths = [p for p in sorted(Path(images).iterdir()) if p.suffix.lower() in IMAGE_EXTS]
+    ims = [decode_image(p.read_bytes()) for p in paths]
+    if not ims:
+        ims = [np.random.default_rng(0).integers(0, 256, (480, 640, 3), dtype=np.uint8)]
+    return [ims[i % len(ims)] for i in range(batch)]
+
+
+def _timed_loop(models: List[YoloModel], ims: List[np.ndarray], seconds: float, barrier) -> List[float]:
+    """forward по моделям по кругу (воркер с несколькими файлами весов чередует их, как батчер)."""
+    for model in models:
+        for _ in range(WARMUP_CALLS):
+            model.forward_batch(ims)
+    barrier.wait()  # все воркеры меряются одновременно — иначе не видно борьбы за ядра
+    times = []
+    deadline = time.perf_counter() + seconds
+    for model in itertools.cycle(models):
+        if time.perf_counter() >= deadline:
+            break
+        started = time.perf_counter()
+        model.forward_batch(ims)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def _bench_process(weights: str, imgsz: int, images: str, batch: int, threads: int, interop: int,
+                   cores: Optional[List[int]], seconds: float, barrier) -> List[float]:
+    """Один процесс-воркер, как в ProcessBackend: свои ядра, свои потоки, своя копия модели."""
+    pin_process(cores)
+    apply_threads(len(cores) if cores else threads, interop)
+    model = YoloModel(weights, device="cpu", imgsz=(imgsz, imgsz))
+    return _timed_loop([model], _load_batch(images, batch), seconds, barrier)
+
+
+def _bench_threads(weights: List[str], imgsz: int, images: str, batch: int, workers: int, threads: int,
+                   interop: int, seconds: float) -> List[List[float]]:
+    """Один процесс, как ThreadBackend: workers потоков делят файлы весов, потоки PyTorch общие."""
+    apply_threads(threads, interop)
+    models = {w: YoloModel(w, device="cpu", imgsz=(imgsz, imgsz)) for w in set(weights)}
+    ims = _load_batch(images, batch)
+    barrier = threading.Barrier(workers)
+    per_worker: List[List[float]] = [[] for _ in range(workers)]
+
+    def run(i: int) -> None:
+        per_worker[i] = _timed_loop([models[w] for w in weights[i::workers]], ims, seconds, barrier)
+
+    pool = [threading.Thread(target=run, args=(i,)) for i in range(workers)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return per_worker
+
+
+def measure(layout: ThreadLayout, args: argparse.Namespace, weights: List[str]) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    if args.backend == "thread":
+        with ProcessPoolExecutor(1, mp_context=ctx) as executor:
+            per_worker = executor.submit(_bench_threads, weights, args.imgsz, args.images, args.batch,
+                                         layout.workers, layout.threads, layout.interop, args.seconds).result()
+    else:
+        with ctx.Manager() as manager, ProcessPoolExecutor(layout.workers, mp_context=ctx) as executor:
+            barrier = manager.Barrier(layout.workers)
+            futures = [executor.submit(_bench_process, weights[i % len(weights)], args.imgsz, args.images,
+                                       args.batch, layout.threads, layout.interop, cores, args.seconds, barrier)
+                       for i, cores in enumerate(layout.core_sets())]
+            per_worker = [f.result() for f in futures]
+
+    calls = np.array([t for times in per_worker for t in times])
+    wall = max(sum(times) for times in per_worker)
+    return {"layout": layout, "calls": len(calls),
+            "images_per_sec": len(calls) * args.batch / wall,
+            "p50_ms": float(np.percentile(calls, 50)) * 1000,
+            "p95_ms": float(np.percentile(calls, 95)) * 1000}
+
+
+def candidates(args: argparse.Namespace, cpus: int) -> List[ThreadLayout]:
+    """Все forward x потоки, которые помещаются в ядра, плюс «как без настройки» для сравнения."""
+    if args.backend == "thread":  # больше одновременных forward, чем файлов весов, батчер не запустит
+        workers = args.workers or list(range(1, len(args.weights) + 1))
+        baseline = len(args.weights)
+    else:
+        workers = args.workers or [w for w in (1, 2, 3, 4, 6, 8, 12, 16) if w <= cpus]
+        baseline = args.baseline_workers
+    threads = args.threads or [t for t in (1, 2, 4, 6, 8, 12, 16, 24, 32) if t <= cpus]
+    layouts = [ThreadLayout(workers=w, threads=t) for w in workers for t in threads if w * t <= cpus]
+    # как до раскладки: каждый forward без закрепления берёт все ядра (и столько же inter-op)
+    layouts.append(ThreadLayout(workers=baseline, threads=cpus, interop=cpus, pin=False))
+    return layouts
+
+
+def describe(layout: ThreadLayout, backend: str) -> str:
+    if not layout.pin:
+        return f"{layout.workers} x {layout.threads} (как было)"
+    pinned = ", ядра" if backend == "process" and layout.core_sets()[0] is not None else ""
+    return f"{layout.workers} x {layout.threads}{pinned}"
+
+
+def tune(args: argparse.Namespace) -> dict:
+    weights = [os.path.join(args.work_dir, w) for w in args.weights]
+    cpus = len(available_cpus())
+    rows = []
+    print(f"Ядер: {cpus}, бэкенд: {args.backend}, веса: {' '.join(args.weights)}, batch={args.batch}")
+    for layout in candidates(args, cpus):
+        row = measure(layout, args, weights)
+        rows.append(row)
+        print(f"  {describe(layout, args.backend):<20} {row['images_per_sec']:>7.2f} фото/с"
+              f"  p50={row['p50_ms']:.0f} мс  p95={row['p95_ms']:.0f} мс")
+
+    key = (lambda r: -r["images_per_sec"]) if args.objective == "throughput" else (lambda r: r["p95_ms"])
+    rows.sort(key=key)
+    best = rows[0]["layout"]
+    print(f"\n{'forward x потоки':<20} {'фото/с':>7} {'p50, мс':>8} {'p95, мс':>8}")
+    for row in rows:
+        print(f"{describe(row['layout'], args.backend):<20} {row['images_per_sec']:>7.2f}"
+              f" {row['p50_ms']:>8.0f} {row['p95_ms']:>8.0f}")
+    results = [{**{k: v for k, v in row.items() if k != "layout"},
+                "workers": row["layout"].workers, "threads": row["layout"].threads,
+                "interop": row["layout"].interop, "pin": row["layout"].pin} for row in rows]
+    if not args.no_save:
+        out = args.out or os.path.join(args.work_dir, "thread_layout.json")
+        save_layout(out, best, args.backend, weights=args.weights, batch=args.batch, objective=args.objective,
+                    tuned_at=datetime.now().isoformat(timespec="seconds"), results=results)
+        print(f"Лучшая раскладка {describe(best, args.backend)} сохранена в {out}")
+    return {"backend": args.backend, "cpus": cpus, "best": results[0], "results": results}
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Подбор одновременных forward x потоков PyTorch для бэкенда бота")
+    parser.add_argument("--backend", choices=("thread", "process"), default="thread", help="INFERENCE_BACKEND бота")
+    parser.add_argument("--work-dir", default=".", help="папка весов (WORK_DIR бота)")
+    parser.add_argument("--weights", nargs="+", default=["yolov5x.pt"],
+                        help="веса или артефакты экспорта (exported/...); каскад — оба файла")
+    parser.add_argument("--images", default=str(Path(__file__).resolve().parent / "IMG_test"))
+    parser.add_argument("--batch", type=int, default=1, help="картинок в одном forward (1 — одиночные запросы)")
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--seconds", type=float, default=10, help="длительность замера одной раскладки")
+    parser.add_argument("--workers", type=int, nargs="+",
+                        help="варианты числа одновременных forward (по умолчанию: process — до числа ядер,"
+                             " thread — до числа файлов весов)")
+    parser.add_argument("--threads", type=int, nargs="+", help="варианты потоков PyTorch на forward")
+    parser.add_argument("--baseline-workers", type=int, default=2,
+                        help="процессов в строке «без настройки» для process (INFERENCE_WORKERS бота)")
+    parser.add_argument("--objective", choices=("throughput", "latency"), default="throughput",
+                        help="что оптимизировать: фото/с или p95 одного forward")
+    parser.add_argument("--out", help="куда сохранить раскладку (по умолчанию WORK_DIR/thread_layout.json)")
+    parser.add_argument("--no-save", action="store_true", help="только показать замеры")
+    parser.add_argument("--json", help="сохранить все замеры в JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    summary = tune(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(summary, fh, ensure_ascii=False, indent=2)
@@ -0,0 +1,94 @@
+"""Webhook-режим: локальный aiohttp-сервер принимает обновления Telegram вместо long polling."""
+
+import asyncio
+import hmac
+import signal
+import logging
+from typing import Optional
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"  # Telegram присылает secret_token из setWebhook
+APP_KEY = web.AppKey("application", Application)  # PTB-приложение внутри aiohttp-приложения
+SECRET_KEY = web.AppKey("secret_token", str)
+
+
+async def _handle_update(request: web.Request) -> web.Response:
+    """Проверяет секрет и кладёт обновление в очередь PTB — дальше работают те же хендлеры."""
+    secret = request.app[SECRET_KEY]
+    # байты, а не str: compare_digest падает с TypeError на не-ASCII заголовке (вместо 403 был бы 500)
+    if not hmac.compare_digest(request.headers.get(SECRET_HEADER, "").encode("utf-8"), secret.encode("utf-8")):
+        return web.Response(status=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    application = request.app[APP_KEY]
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return web.Response()  # Telegram ждёт только 200: обработка идёт асинхронно
+
+
+async def _handle_health(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+
+def build_web_app(application: Application, path: str, secret_token: str) -> web.Application:
+    """aiohttp-приложение с маршрутом вебхука (сюда же можно добавить служебные маршруты)."""
+    app = web.Application()
+    app[APP_KEY] = application
+    app[SECRET_KEY] = secret_token
+    app.router.add_post(path, _handle_update)
+    app.router.add_get("/healthz", _handle_health)
+    return app
+
+
+async def run_webhook(application: Application,
+                      listen: str,
+                      port: int,
+                      path: str,
+                      secret_token: str,
+                      public_url: Optional[str] = None,
+                      drop_pending_updates: bool = True,
+                      web_app: Optional[web.Application] = None) -> None:
+    """Запускает PTB-приложение и HTTP-сервер вебхука; работает до SIGINT/SIGTERM.
+
+    public_url — внешний адрес (https://bot.example.com), по которому Telegram достучится до сервера;
+    если не задан, setWebhook не вызывается (вебхук настроен снаружи, например обратным прокси).
+    """
+    web_app = web_app or build_web_app(application, path, secret_token)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):  # Windows: остаётся KeyboardInterrupt
+            pass
+
+    runner = web.AppRunner(web_app, access_log=None)  # без строки лога на каждое обновление
+    try:
+        async with application:
+            if application.post_init:  # run_polling вызывает post_init сам, здесь — мы
+                await application.post_init(application)
+            if public_url:
+                await application.bot.set_webhook(
+                    url=public_url.rstrip("/") + path,
+                    secret_token=secret_token,
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=drop_pending_updates,
+                )
+            await application.start()
+            await runner.setup()
+            await web.TCPSite(runner, listen, port).start()
+            logger.info("Вебхук слушает http://%s:%d%s", listen, port, path)
+            try:
+                await stop.wait()
+            finally:
+                await runner.cleanup()
+                await application.stop()
+    finally:
+        if application.post_shutdown:  # и post_shutdown, как run_polling после остановки
+            await application.post_shutdown(application)
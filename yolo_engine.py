@@ -0,0 +1,849 @@
+"""Резидентный движок YOLOv5: веса загружаются один раз и обслуживают все запросы из памяти."""
+
+import os
+import sys  # для добавления локальной папки yolov5 в пути Python
+import multiprocessing  # контекст spawn для процессов инференса
+import asyncio  # очередь микробатчинга живёт в event loop бота
+import logging  # логирование загрузки моделей
+import threading  # защита реестра моделей при одновременных обращениях из потоков
+import time  # замер длительности заявок для оценки времени ожидания
+import queue  # приоритетная очередь задач потоков инференса (и ядра для процессов-воркеров)
+import itertools
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path  # удобная работа с путями
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+# --- Подключение локальной папки yolov5 ---------------------------------------
+CURRENT_DIR = Path(__file__).resolve().parent  # папка проекта
+YOLOV5_DIR = CURRENT_DIR / "yolov5"  # локальная копия yolov5
+
+if str(YOLOV5_DIR) not in sys.path:  # добавляем yolov5 в sys.path для импорта его модулей
+    sys.path.insert(0, str(YOLOV5_DIR))
+
+from ultralytics.utils.plotting import Annotator, colors  # noqa: E402  отрисовка рамок как в detect.py
+from models.common import DetectMultiBackend  # noqa: E402
+from utils.augmentations import letterbox  # noqa: E402
+from utils.general import check_img_size, cv2, non_max_suppression, scale_boxes, yaml_load  # noqa: E402
+from utils.torch_utils import select_device  # noqa: E402
+from cpu_layout import ThreadLayout, apply_threads, pin_process  # noqa: E402  потоки и ядра воркеров
+
+logger = logging.getLogger(__name__)  # логгер модуля
+
+DEFAULT_DATA = YOLOV5_DIR / "data" / "coco128.yaml"  # yaml с именами классов COCO
+DEFAULT_IMGSZ = (640, 640)  # размер изображения для инференса (h, w)
+CONF_FLOOR = 0.01  # нижний conf детекций в cache/: порог пользователя применяется после NMS, без инференса
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp")  # картинки локальных папок (калибровка, замеры, оценка)
+DEFAULT_LANE_WEIGHTS = {"admin": 4.0, "fast": 3.0, "pro": 1.0}  # доли полос планировщика
+PRIORITY_NORMAL = 0  # задачи потоков инференса: интерактивные запросы
+PRIORITY_LOW = 1  # ячейки pro-грида — уступают очередь, пока ждут быстрые запросы
+
+
+class YoloModel:
+    """Загруженная в память модель YOLOv5: препроцессинг, forward, NMS и отрисовка без detect.run."""
+
+    def __init__(self,
+                 weights_path: str,
+                 device: str = "",
+                 imgsz: Tuple[int, int] = DEFAULT_IMGSZ,
+                 data: Optional[str] = None) -> None:
+        self.weights_path = str(weights_path)  # путь к весам (ключ в реестре)
+        self.device = select_device(device)  # выбираем устройство один раз
+        self.model = DetectMultiBackend(self.weights_path,
+                                        device=self.device,
+                                        dnn=False,
+                                        data=str(data or DEFAULT_DATA),
+                                        fp16=False)  # загрузка весов + fuse Conv/BN
+        self.stride, self.names, self.pt = self.model.stride, self.model.names, self.model.pt
+        self.imgsz = check_img_size(imgsz, s=self.stride)  # размер, кратный stride
+
+    def warmup(self) -> None:
+        """Прогоняет пустой тензор, чтобы первый реальный запрос не платил за инициализацию."""
+        im = torch.zeros(1, 3, *self.imgsz, device=self.device)
+        with torch.inference_mode():
+            self.model(im)
+
+    def preprocess(self, im0: np.ndarray, auto: Optional[bool] = None) -> torch.Tensor:
+        """BGR-картинка -> нормированный тензор (1, 3, h, w), как в LoadImages из detect.py.
+
+        auto=False даёт ровно imgsz (без минимального прямоугольника) — общий размер для батча.
+        """
+        auto = self.pt if auto is None else auto
+        im = letterbox(im0, self.imgsz, stride=self.stride, auto=auto)[0]  # resize + padding
+        im = im.transpose((2, 0, 1))[::-1]  # HWC -> CHW, BGR -> RGB
+        im = torch.from_numpy(np.ascontiguousarray(im)).to(self.device)
+        return (im.float() / 255)[None]  # 0..255 -> 0.0..1.0, добавляем batch
+
+    def forward(self, im0: np.ndarray) -> Tuple[torch.Tensor, Tuple[int, int]]:
+        """Один forward модели: сырые предсказания до NMS и размер входа сети (h, w)."""
+        with torch.inference_mode():
+            im = self.preprocess(im0)
+            pred = self.model(im)
+        if isinstance(pred, (list, tuple)):  # некоторые бэкенды возвращают (inference_out, ...)
+            pred = pred[0]
+        return pred, tuple(im.shape[2:])
+
+    def forward_batch(self, ims0: List[np.ndarray]) -> Tuple[torch.Tensor, Tuple[int, int]]:
+        """Один forward для нескольких картинок: все приводятся к imgsz и складываются в батч."""
+        with torch.inference_mode():
+            im = torch.cat([self.preprocess(im0, auto=False) for im0 in ims0])
+            pred = self.model(im)
+        if isinstance(pred, (list, tuple)):
+            pred = pred[0]
+        return pred, tuple(im.shape[2:])
+
+    @staticmethod
+    def postprocess(pred: torch.Tensor,
+                    input_shape: Tuple[int, int],
+                    im0_shape: Tuple[int, ...],
+                    conf_thres: float,
+                    iou_thres: float,
+                    classes: Optional[List[int]] = None,
+                    max_det: int = 1000) -> torch.Tensor:
+        """NMS по сырым предсказаниям одной картинки -> (n, 6) в координатах исходной картинки.
+
+        pred не изменяется, поэтому один и тот же forward можно прогонять через несколько порогов.
+        """
+        with torch.inference_mode():
+            det = non_max_suppression(pred, conf_thres, iou_thres, classes, False, max_det=max_det)[0]
+            if len(det):
+                det[:, :4] = scale_boxes(input_shape, det[:, :4], im0_shape).round()  # обратно в размер im0
+        return det
+
+    def detect(self,
+               im0: np.ndarray,
+               conf_thres: float,
+               iou_thres: float,
+               classes: Optional[List[int]] = None,
+               max_det: int = 1000) -> torch.Tensor:
+        """Возвращает детекции (n, 6) [xyxy, conf, cls] в координатах исходной картинки."""
+        pred, input_shape = self.forward(im0)
+        return self.postprocess(pred, input_shape, im0.shape, conf_thres, iou_thres, classes, max_det)
+
+    def render(self, im0: np.ndarray, det, line_thickness: int = 3) -> np.ndarray:
+        """Рисует рамки и подписи на копии картинки (формат подписи как в detect.py)."""
+        return render_detections(im0, det, self.names, line_thickness)
+
+
+def render_detections(im0: np.ndarray,
+                      det,
+                      names,
+                      line_thickness: int = 3,
+                      hide_conf: bool = False) -> np.ndarray:
+    """Отрисовка детекций (n, 6) без модели — нужны только имена классов."""
+    annotator = Annotator(im0.copy(), line_width=line_thickness, example=str(names))
+    for *xyxy, conf, cls in reversed(det):
+        c = int(cls)
+        label = names[c] if hide_conf else f"{names[c]} {conf:.2f}"
+        annotator.box_label(xyxy, label, color=colors(c, True))
+    return annotator.result()
+
+
+def render_jpegs(image_bytes: bytes,
+                 dets: List[np.ndarray],
+                 names,
+                 line_thickness: int = 3,
+                 hide_conf: bool = False) -> List[bytes]:
+    """Декодирует картинку один раз и рисует на ней каждый набор детекций -> список JPEG."""
+    im0 = decode_image(image_bytes)
+    return [encode_jpeg(render_detections(im0, det, names, line_thickness, hide_conf)) for det in dets]
+
+
+def load_class_names(data: Optional[str] = None) -> Dict[int, str]:
+    """Имена классов из yaml датасета (для отрисовки в процессе, где модель не загружена)."""
+    return yaml_load(str(data or DEFAULT_DATA))["names"]
+
+
+@dataclass
+class GridResult:
+    """Результат инференса: детекции по ячейкам грида и размер исходной картинки (без отрисовки)."""
+    dets: List[np.ndarray]  # (n, 6) [xyxy, conf, cls] в координатах исходной картинки
+    shape: Tuple[int, int]  # (h, w) исходной картинки
+
+
+@dataclass(frozen=True)
+class CascadePolicy:
+    """Каскад моделей: когда ответ лёгкой модели не принимается и картинка уходит тяжёлой.
+
+    Решение принимается по детекциям лёгкой модели при conf = CONF_FLOOR (как они лежат в cache/),
+    поэтому его можно пересчитать без инференса.
+    """
+    conf: float = 0.5                               # порог, с которым пользователь видит боксы
+    band: Tuple[float, float] = (0.25, 0.5)         # «сомнительные» боксы: band[0] <= conf < band[1]
+    max_uncertain: int = 2                          # сомнительных боксов больше — эскалация
+    escalate_if_empty: bool = True                  # ни одного уверенного бокса нужных классов — эскалация
+
+    def escalate(self, det: np.ndarray, classes: Optional[List[int]] = None) -> Optional[str]:
+        """Причина эскалации ("empty" | "uncertain") или None — ответ лёгкой модели принимается."""
+        if classes is not None:
+            det = det[np.isin(det[:, 5], classes)]
+        conf = det[:, 4]
+        if self.escalate_if_empty and not (conf >= self.conf).any():
+            return "empty"
+        if int(((conf >= self.band[0]) & (conf < self.band[1])).sum()) > self.max_uncertain:
+            return "uncertain"
+        return None
+
+
+class ModelRegistry:
+    """Реестр резидентных моделей: каждый файл весов загружается ровно один раз за жизнь процесса."""
+
+    def __init__(self,
+                 device: str = "",
+                 imgsz: Tuple[int, int] = DEFAULT_IMGSZ,
+                 runtime_paths: Optional[Dict[str, str]] = None) -> None:
+        self.device = device
+        self.imgsz = imgsz
+        # путь к .pt -> что загружать вместо него (экспорт ONNX/OpenVINO); ключом модели остаётся .pt
+        self.runtime_paths = {str(Path(k)): v for k, v in (runtime_paths or {}).items()}
+        self._models: Dict[str, YoloModel] = {}  # путь к весам -> загруженная модель
+        self._lock = threading.Lock()  # загрузка из нескольких потоков не должна дублироваться
+
+    def get(self, weights_path: str) -> YoloModel:
+        """Возвращает загруженную модель; при первом обращении загружает и прогревает её."""
+        key = str(Path(weights_path))  # нормализуем путь, чтобы "a/b" и "a\\b" не грузились дважды
+        model = self._models.get(key)
+        if model is not None:
+            return model
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                path = self.runtime_paths.get(key, key)
+                logger.info("Загрузка модели в память: %s", path)
+                model = YoloModel(path, device=self.device, imgsz=self.imgsz)
+                model.warmup()
+                self._models[key] = model
+        return model
+
+    def preload(self, weights_paths: Iterable[str]) -> None:
+        """Загружает список весов заранее (вызывается при старте бота)."""
+        for weights_path in weights_paths:
+            self.get(weights_path)
+
+
+class PoolBusyError(RuntimeError):
+    """Очередь инференса заполнена — заявку нужно отклонить сразу."""
+
+
+class PriorityExecutor:
+    """Пул потоков с приоритетной очередью: задача с меньшим priority берётся первой, внутри уровня — FIFO.
+
+    Уже запущенные задачи не прерываются, но ожидающие низкого приоритета пропускают вперёд новые.
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str = "yolo") -> None:
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._queue: "queue.PriorityQueue" = queue.PriorityQueue()
+        self._seq = itertools.count()  # порядок поступления внутри одного приоритета
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def submit(self, priority: int, func, *args) -> Future:
+        self._start()
+        future: Future = Future()
+        self._queue.put((priority, next(self._seq), future, func, args))
+        return future
+
+    def shutdown(self) -> None:
+        for _ in self._threads:
+            self._queue.put((float("inf"), next(self._seq), None, None, None))
+
+    def _start(self) -> None:
+        if self._threads:
+            return
+        with self._lock:  # потоки создаются при первой задаче (в т.ч. не создаются в процессах-воркерах)
+            if not self._threads:
+                for i in range(self.max_workers):
+                    thread = threading.Thread(target=self._worker, name=f"{self.thread_name_prefix}_{i}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _worker(self) -> None:
+        while True:
+            _, _, future, func, args = self._queue.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+class _DRRQueue:
+    """Deficit round robin между потоками заявок (пользователями): каждый получает квант за круг."""
+
+    def __init__(self, quantum: float = 1.0) -> None:
+        self.quantum = quantum
+        self._flows: Dict[Any, deque] = {}  # пользователь -> очередь (стоимость, заявка)
+        self._deficit: Dict[Any, float] = {}
+        self._active: deque = deque()  # пользователи с заявками, в порядке обхода
+        self._new_turn = True  # голове _active ещё не начислен квант этого круга
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def push(self, flow: Any, item: Any, cost: float) -> None:
+        items = self._flows.get(flow)
+        if items is None:
+            items = self._flows[flow] = deque()
+            self._deficit[flow] = 0.0
+            self._active.append(flow)
+        items.append((cost, item))
+        self._size += 1
+
+    def pop(self) -> Tuple[Any, float]:
+        while True:
+            flow = self._active[0]
+            items = self._flows[flow]
+            if self._new_turn:
+                self._deficit[flow] += self.quantum
+                self._new_turn = False
+            cost, item = items[0]
+            if cost <= self._deficit[flow]:
+                items.popleft()
+                self._size -= 1
+                self._deficit[flow] -= cost
+                if not items:  # пользователь выбыл из круга — остаток кванта не копится
+                    del self._flows[flow], self._deficit[flow]
+                    self._active.popleft()
+                    self._new_turn = True
+                return item, cost
+            self._active.rotate(-1)  # кванта не хватает — ход следующему пользователю
+            self._new_turn = True
+
+
+class FairScheduler:
+    """Взвешенный планировщик мест в стадии инференса (вместо FIFO-семафора).
+
+    Между полосами (admin / fast / pro) — взвешенная справедливая очередь: полоса с весом 3
+    получает втрое больше «стоимости», чем с весом 1, и ни одна не голодает. Внутри полосы —
+    deficit round robin между пользователями. Стоимость заявки — число ячеек грида.
+    Вызывается только из event loop.
+    """
+
+    def __init__(self, capacity: int, weights: Dict[str, float]) -> None:
+        self.capacity = capacity
+        self.weights = dict(weights)
+        self._free = capacity
+        self._queues = {lane: _DRRQueue() for lane in self.weights}
+        self._pass = {lane: 0.0 for lane in self.weights}  # виртуальное время полосы
+        self._vtime = 0.0  # виртуальное время последней выданной заявки
+
+    def waiting(self, lane: Optional[str] = None) -> int:
+        if lane is not None:
+            return len(self._queues[lane])
+        return sum(len(q) for q in self._queues.values())
+
+    async def acquire(self, lane: str, user: Any = None, cost: float = 1.0) -> None:
+        if self._free > 0 and not self.waiting():
+            self._free -= 1
+            self._charge(lane, cost)
+            return
+        if not self._queues[lane]:  # полоса простаивала — не копит «кредит» за простой
+            self._pass[lane] = max(self._pass[lane], self._vtime)
+        future = asyncio.get_running_loop().create_future()
+        self._queues[lane].push(user, future, cost)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # место уже выдано, но заявку отменили — возвращаем
+            raise
+
+    def release(self) -> None:
+        self._free += 1
+        while self._free > 0:
+            lanes = [lane for lane in self.weights if self._queues[lane]]
+            if not lanes:
+                return
+            lane = min(lanes, key=lambda name: self._pass[name])
+            future, cost = self._queues[lane].pop()
+            if future.cancelled():  # заявка ушла по тайм-ауту, пока ждала
+                continue
+            self._free -= 1
+            self._charge(lane, cost)
+            future.set_result(None)
+
+    def _charge(self, lane: str, cost: float) -> None:
+        start = max(self._pass[lane], self._vtime)
+        self._vtime = start
+        self._pass[lane] = start + cost / self.weights[lane]
+
+
+class InferencePool:
+    """Выделенный пул инференса: фиксированное число потоков и ограниченная очередь заявок.
+
+    Методы admit/leave/slot вызываются только из event loop, поэтому счётчики без блокировок.
+    """
+
+    def __init__(self,
+                 workers: int = 2,
+                 max_queue: int = 16,
+                 inflight: Optional[int] = None,
+                 lane_weights: Optional[Dict[str, float]] = None) -> None:
+        self.workers = workers  # потоков инференса (forward, NMS, отрисовка)
+        self.max_queue = max_queue  # сколько заявок может ждать своей очереди
+        self.inflight = inflight or workers  # заявок в стадии инференса одновременно (>= размера микробатча)
+        self.executor = PriorityExecutor(max_workers=workers, thread_name_prefix="yolo")
+        self.scheduler = FairScheduler(self.inflight, lane_weights or DEFAULT_LANE_WEIGHTS)
+        self._active = 0  # заявок в системе: в работе + в очереди
+        self._avg_sec: Optional[float] = None  # скользящее среднее длительности заявки
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def admit(self) -> int:
+        """Принимает заявку; возвращает число заявок, ожидающих впереди (0 — старт сразу)."""
+        if self._active >= self.inflight + self.max_queue:
+            raise PoolBusyError(f"Очередь инференса заполнена ({self._active} заявок)")
+        ahead = max(0, self._active - self.inflight + 1)
+        self._active += 1
+        return ahead
+
+    def leave(self) -> None:
+        """Заявка покинула систему (готова, отменена или взята из кеша)."""
+        self._active = max(0, self._active - 1)
+
+    def expected_wait(self, ahead: int) -> Optional[float]:
+        """Оценка ожидания в секундах для позиции ahead; None — пока нет статистики."""
+        if self._avg_sec is None:
+            return None
+        return -(-ahead // self.inflight) * self._avg_sec  # ceil(ahead / inflight) «волн» обработки
+
+    @asynccontextmanager
+    async def slot(self, lane: str = "fast", user: Any = None, cost: float = 1.0) -> AsyncIterator[None]:
+        """Занимает место в стадии инференса (очередь полосы lane) и обновляет среднюю длительность заявки."""
+        await self.scheduler.acquire(lane, user, cost)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self._avg_sec = elapsed if self._avg_sec is None else 0.8 * self._avg_sec + 0.2 * elapsed
+            self.scheduler.release()
+
+    async def run(self, func, *args, priority: int = PRIORITY_NORMAL):
+        """Выполняет синхронную функцию в потоках пула (а не в общем to_thread)."""
+        return await asyncio.wrap_future(self.executor.submit(priority, func, *args))
+
+
+class BatchScheduler:
+    """Динамический микробатчинг: запросы разных пользователей, пришедшие в одном окне, идут одним forward.
+
+    Для каждого файла весов — своя очередь: пока идёт forward, следующий батч уже набирается,
+    а потоки не конкурируют за ядра CPU отдельными batch-1 прогонами. Что именно делать с батчем,
+    решает run_batch(weights_path, items) -> results (по одному результату на элемент).
+    """
+
+    def __init__(self,
+                 run_batch: Callable[[str, List[Any]], Awaitable[List[Any]]],
+                 window_ms: float = 20,
+                 max_batch: int = 8,
+                 parallel_batches: int = 1) -> None:
+        self.run_batch = run_batch
+        self.window = window_ms / 1000  # окно ожидания попутчиков, сек
+        self.max_batch = max_batch  # максимум элементов в одном батче
+        self.parallel_batches = parallel_batches  # сколько батчей может выполняться одновременно
+        self._queues: Dict[str, asyncio.Queue] = {}  # веса -> очередь (элемент, future)
+        self._workers: Dict[str, asyncio.Task] = {}  # веса -> задача-сборщик батчей
+
+    async def submit(self, weights_path: str, item: Any) -> Any:
+        """Ставит элемент в очередь и ждёт результат, посчитанный в общем батче."""
+        return (await self.submit_many(weights_path, [item]))[0]
+
+    async def submit_many(self, weights_path: str, items: List[Any]) -> List[Any]:
+        """Группа элементов (альбом) идёт в батч целиком: её не делят между батчами.
+
+        Группа больше max_batch делится на части по max_batch.
+        """
+        key = str(Path(weights_path))
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = asyncio.Queue()
+        worker = self._workers.get(key)
+        if worker is None or worker.done():
+            self._workers[key] = asyncio.create_task(self._worker(key, queue))
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in items]
+        for start in range(0, len(items), self.max_batch):
+            queue.put_nowait(list(zip(items[start:start + self.max_batch], futures[start:start + self.max_batch])))
+        return list(await asyncio.gather(*futures))
+
+    async def _collect(self, queue: asyncio.Queue, carry: Optional[list]) -> Tuple[list, Optional[list]]:
+        """Первую группу ждём сколько угодно, остальные — не дольше окна и не больше max_batch.
+
+        Группа, которая уже не помещается, возвращается как carry и открывает следующий батч.
+        """
+        loop = asyncio.get_running_loop()
+        batch = carry or await queue.get()
+        carry = None
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                group = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if len(batch) + len(group) > self.max_batch:
+                carry = group
+                break
+            batch = batch + group
+        return [(item, fut) for item, fut in batch if not fut.done()], carry  # отменённые (тайм-аут) выкидываем
+
+    async def _worker(self, weights_path: str, queue: asyncio.Queue) -> None:
+        running = asyncio.Semaphore(self.parallel_batches)
+        carry = None
+        while True:
+            # батч собираем, только когда есть свободный исполнитель: пока все заняты,
+            # новые заявки копятся в очереди и уходят следующим батчем целиком
+            await running.acquire()
+            batch, carry = await self._collect(queue, carry)
+            if not batch:
+                running.release()
+                continue
+            task = asyncio.create_task(self._run(weights_path, batch))
+            task.add_done_callback(lambda _: running.release())
+
+    async def _run(self, weights_path: str, batch: list) -> None:
+        try:
+            results = await self.run_batch(weights_path, [item for item, _ in batch])
+        except Exception as e:  # ошибку отдаём всем ожидающим, сборщик продолжает работу
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        logger.debug("Микробатч: %d изображений, weights=%s", len(batch), weights_path)
+        for (_, fut), result in zip(batch, results):
+            if not fut.done():
+                fut.set_result(result)
+
+
+def nms_cell(model: YoloModel,
+             pred: torch.Tensor,
+             input_shape: Tuple[int, int],
+             im0_shape: Tuple[int, ...],
+             conf: float,
+             iou: float,
+             classes: Optional[List[int]]) -> np.ndarray:
+    """NMS одной ячейки грида (conf, iou) по готовому forward -> детекции (n, 6) float32."""
+    det = model.postprocess(pred, input_shape, im0_shape, conf, iou, classes)
+    return det.cpu().numpy().astype(np.float32)
+
+
+def select_detections(det: np.ndarray, conf: float, classes: Optional[List[int]]) -> np.ndarray:
+    """То, что увидит пользователь: conf-порог и фильтр классов поверх детекций при CONF_FLOOR."""
+    keep = det[:, 4] >= conf
+    if classes is not None:
+        keep &= np.isin(det[:, 5], classes)
+    return det[keep]
+
+
+# --- Бэкенды инференса ----------------------------------------------------------
+# Оба бэкенда дают одинаковый интерфейс:
+#   detect(weights, image_bytes, grid, classes) -> GridResult  (детекции, без отрисовки)
+#   detect_iter(...) -> async (index, det, shape) по ячейкам грида, по мере готовности
+#   detect_batch(weights, [image_bytes], grid, classes) -> [GridResult | Exception]  (альбом одной группой)
+#   render(image_bytes, dets, names, line_thickness, hide_conf) -> [JPEG-байты]
+# Необязательный priority (PRIORITY_LOW для pro-грида) пропускает вперёд быстрые запросы.
+Grid = List[Tuple[float, float]]  # ячейки (conf, iou), считаемые по одному forward
+
+
+class ThreadBackend:
+    """Модель живёт в процессе бота; forward, NMS и отрисовка — в потоках InferencePool.
+
+    Батчер ведёт один forward на файл весов за раз, но файлов может быть несколько (каскад), и их forward
+    идут одновременно. layout делит ядра: не больше layout.workers forward сразу, у каждого
+    layout.threads потоков PyTorch (число потоков общее на процесс, ядра не закрепляются).
+    """
+
+    def __init__(self,
+                 registry: ModelRegistry,
+                 pool: InferencePool,
+                 window_ms: float = 20,
+                 max_batch: int = 8,
+                 layout: Optional[ThreadLayout] = None) -> None:
+        self.registry = registry
+        self.pool = pool
+        self.batcher = BatchScheduler(self._forward_batch, window_ms=window_ms, max_batch=max_batch)
+        self._forwards: Optional[asyncio.Semaphore] = None  # одновременные forward по всем файлам весов
+        if layout is not None:
+            apply_threads(layout.threads, layout.interop)
+            self._forwards = asyncio.Semaphore(layout.workers)
+
+    def preload(self, weights_paths: Iterable[str]) -> None:
+        self.registry.preload(weights_paths)
+
+    async def _forward_batch(self, weights_path: str, ims0: List[np.ndarray]) -> list:
+        model = await self.pool.run(self.registry.get, weights_path)
+        if self._forwards is None:
+            pred, input_shape = await self.pool.run(model.forward_batch, ims0)
+        else:
+            async with self._forwards:
+                pred, input_shape = await self.pool.run(model.forward_batch, ims0)
+        return [(pred[i:i + 1], input_shape) for i in range(len(ims0))]
+
+    async def detect(self,
+                     weights_path: str,
+                     image_bytes: bytes,
+                     grid: Grid,
+                     classes: Optional[List[int]],
+                     priority: int = PRIORITY_NORMAL) -> GridResult:
+        dets: List[Optional[np.ndarray]] = [None] * len(grid)
+        shape = (0, 0)
+        async for i, det, shape in self.detect_iter(weights_path, image_bytes, grid, classes, priority):
+            dets[i] = det
+        return GridResult(dets, shape)
+
+    async def detect_batch(self,
+                           weights_path: str,
+                           images: List[bytes],
+                           grid: Grid,
+                           classes: Optional[List[int]],
+                           priority: int = PRIORITY_NORMAL) -> List[Union[GridResult, Exception]]:
+        """Несколько картинок сразу: все декодируются, затем одной группой идут в общий forward."""
+        ims0 = await asyncio.gather(*(self.pool.run(decode_image, b, priority=priority) for b in images),
+                                    return_exceptions=True)
+        results: List[Union[GridResult, Exception]] = list(ims0)  # ошибка декода остаётся у своей картинки
+        good = [i for i, im0 in enumerate(ims0) if not isinstance(im0, Exception)]
+        if not good:
+            return results
+        model = await self.pool.run(self.registry.get, weights_path)
+        outputs = await self.batcher.submit_many(weights_path, [ims0[i] for i in good])
+
+        async def one(im0: np.ndarray, pred: torch.Tensor, input_shape: Tuple[int, int]) -> GridResult:
+            dets = await asyncio.gather(*(self.pool.run(nms_cell, model, pred, input_shape, im0.shape, conf, iou,
+                                                        classes, priority=priority) for conf, iou in grid))
+            return GridResult(list(dets), tuple(im0.shape[:2]))
+
+        done = await asyncio.gather(*(one(ims0[i], pred, input_shape) for i, (pred, input_shape) in zip(good, outputs)))
+        for i, result in zip(good, done):
+            results[i] = result
+        return results
+
+    async def detect_iter(self,
+                          weights_path: str,
+                          image_bytes: bytes,
+                          grid: Grid,
+                          classes: Optional[List[int]],
+                          priority: int = PRIORITY_NORMAL) -> AsyncIterator[Tuple[int, np.ndarray, Tuple[int, int]]]:
+        im0 = await self.pool.run(decode_image, image_bytes, priority=priority)  # картинка прямо из байтов Telegram
+        model = await self.pool.run(self.registry.get, weights_path)
+        pred, input_shape = await self.batcher.submit(weights_path, im0)  # forward в общем батче
+        shape = tuple(im0.shape[:2])
+
+        async def cell(i: int, conf: float, iou: float) -> Tuple[int, np.ndarray]:
+            return i, await self.pool.run(nms_cell, model, pred, input_shape, im0.shape, conf, iou, classes,
+                                          priority=priority)
+
+        # NMS ячеек независимы — запускаем параллельно и отдаём в порядке готовности
+        tasks = [asyncio.ensure_future(cell(i, conf, iou)) for i, (conf, iou) in enumerate(grid)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                i, det = await next_done
+                yield i, det, shape
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def render(self,
+                     image_bytes: bytes,
+                     dets: List[np.ndarray],
+                     names,
+                     line_thickness: int = 3,
+                     hide_conf: bool = False,
+                     priority: int = PRIORITY_NORMAL) -> List[bytes]:
+        return await self.pool.run(render_jpegs, image_bytes, dets, names, line_thickness, hide_conf,
+                                   priority=priority)
+
+    def shutdown(self) -> None:
+        pass  # потоки принадлежат InferencePool
+
+
+_worker_registry: Optional[ModelRegistry] = None  # реестр моделей внутри процесса-воркера
+
+
+def _init_worker(device: str,
+                 imgsz: Tuple[int, int],
+                 weights_paths: List[str],
+                 runtime_paths: Optional[Dict[str, str]] = None,
+                 layout: Optional[ThreadLayout] = None,
+                 core_sets: Optional["multiprocessing.Queue"] = None) -> None:
+    """Инициализатор процесса-воркера: свои ядра и потоки, свой DetectMultiBackend, загруженный один раз."""
+    global _worker_registry
+    if layout is not None:
+        try:
+            cores = core_sets.get(timeout=5) if core_sets is not None else None
+        except queue.Empty:  # воркер пересоздан — свободного набора ядер нет
+            cores = None
+        pin_process(cores)
+        apply_threads(len(cores) if cores else layout.threads, layout.interop)
+    _worker_registry = ModelRegistry(device=device, imgsz=imgsz, runtime_paths=runtime_paths)
+    _worker_registry.preload(weights_paths)
+
+
+def _worker_ping() -> int:
+    """Пустая задача: заставляет пул поднять процессы (и загрузить модели) заранее."""
+    time.sleep(0.2)  # держим воркер занятым, чтобы следующий ping ушёл в новый процесс
+    return os.getpid()
+
+
+def _worker_detect_batch(weights_path: str,
+                         jobs: List[Tuple[bytes, Grid, Optional[List[int]]]]) -> List[Union[GridResult, Exception]]:
+    """Весь конвейер внутри воркера: декод, letterbox, общий forward, NMS грида.
+
+    Через pipe ходят только байты картинок внутрь и компактные массивы детекций наружу.
+    Картинка, которая не декодируется, получает свою ошибку и не валит остальные в батче.
+    """
+    model = _worker_registry.get(weights_path)
+    results: List[Union[GridResult, Exception]] = []
+    for image_bytes, _, _ in jobs:
+        try:
+            results.append(decode_image(image_bytes))
+        except ValueError as e:
+            results.append(e)
+    good = [i for i, im0 in enumerate(results) if not isinstance(im0, Exception)]
+    if not good:
+        return results
+    pred, input_shape = model.forward_batch([results[i] for i in good])
+    for k, i in enumerate(good):
+        im0, (_, grid, classes) = results[i], jobs[i]
+        results[i] = GridResult([nms_cell(model, pred[k:k + 1], input_shape, im0.shape, conf, iou, classes)
+                                 for conf, iou in grid], tuple(im0.shape[:2]))
+    return results
+
+
+class ProcessBackend:
+    """Модели в отдельных процессах: препроцессинг, NMS и отрисовка не конкурируют с event loop за GIL."""
+
+    def __init__(self,
+                 workers: int = 2,
+                 device: str = "",
+                 imgsz: Tuple[int, int] = DEFAULT_IMGSZ,
+                 weights_paths: Iterable[str] = (),
+                 window_ms: float = 20,
+                 max_batch: int = 8,
+                 runtime_paths: Optional[Dict[str, str]] = None,
+                 layout: Optional[ThreadLayout] = None) -> None:
+        self.workers = workers
+        ctx = multiprocessing.get_context("spawn")  # fork процесса с torch-потоками небезопасен
+        core_sets = None
+        if layout is not None:
+            core_sets = ctx.Queue()  # каждый воркер при старте забирает свой набор ядер
+            for cores in layout.core_sets():
+                core_sets.put(cores)
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(device, imgsz, [str(Path(w)) for w in weights_paths], runtime_paths, layout, core_sets),
+        )
+        # каждый процесс берёт свой батч — батчей в работе столько же, сколько процессов
+        self.batcher = BatchScheduler(self._run_batch, window_ms=window_ms, max_batch=max_batch,
+                                      parallel_batches=workers)
+
+    def preload(self, weights_paths: Iterable[str]) -> None:
+        """Поднимает все процессы заранее; веса загружаются в инициализаторе каждого воркера."""
+        pings = [self.executor.submit(_worker_ping) for _ in range(self.workers)]
+        pids = {ping.result() for ping in pings}
+        logger.info("Процессы инференса запущены: %s", sorted(pids))
+
+    async def _run_batch(self, weights_path: str, jobs: list) -> List[GridResult]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, _worker_detect_batch, weights_path, jobs)
+
+    async def detect(self,
+                     weights_path: str,
+                     image_bytes: bytes,
+                     grid: Grid,
+                     classes: Optional[List[int]],
+                     priority: int = PRIORITY_NORMAL) -> GridResult:
+        # приоритет ячеек здесь не действует: грид считается в воркере одним вызовом
+        result = await self.batcher.submit(weights_path, (image_bytes, grid, classes))
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def detect_batch(self,
+                           weights_path: str,
+                           images: List[bytes],
+                           grid: Grid,
+                           classes: Optional[List[int]],
+                           priority: int = PRIORITY_NORMAL) -> List[Union[GridResult, Exception]]:
+        """Несколько картинок одной группой микробатча: декод и forward — в одном воркере."""
+        return await self.batcher.submit_many(weights_path, [(image_bytes, grid, classes) for image_bytes in images])
+
+    async def detect_iter(self,
+                          weights_path: str,
+                          image_bytes: bytes,
+                          grid: Grid,
+                          classes: Optional[List[int]],
+                          priority: int = PRIORITY_NORMAL) -> AsyncIterator[Tuple[int, np.ndarray, Tuple[int, int]]]:
+        # весь грид считается в воркере за один вызов — ячейки приходят вместе
+        result = await self.detect(weights_path, image_bytes, grid, classes)
+        for i, det in enumerate(result.dets):
+            yield i, det, result.shape
+
+    async def render(self,
+                     image_bytes: bytes,
+                     dets: List[np.ndarray],
+                     names,
+                     line_thickness: int = 3,
+                     hide_conf: bool = False,
+                     priority: int = PRIORITY_NORMAL) -> List[bytes]:
+        # отрисовка и JPEG-кодирование тоже вне процесса бота (GIL event loop свободен)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, render_jpegs, image_bytes, dets, names,
+                                          line_thickness, hide_conf)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# --- Кодирование/декодирование в памяти ---------------------------------------
+def decode_image(data: bytes) -> np.ndarray:
+    """Байты JPEG/PNG (как пришли из Telegram) -> BGR-картинка без записи на диск."""
+    im0 = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if im0 is None:
+        raise ValueError("Не удалось декодировать изображение")
+    return im0
+
+
+def encode_jpeg(im: np.ndarray, quality: int = 95) -> bytes:
+    """BGR-картинка -> байты JPEG для reply_photo(BytesIO)."""
+    ok, buf = cv2.imencode(".jpg", im, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    if not ok:
+        raise ValueError("Не удалось закодировать изображение в JPEG")
+    return buf.tobytes()
+
+
+# --- Перцептивный хеш (поиск почти-дубликатов) --------------------------------
+def dhash(data: bytes, hash_size: int = 8) -> int:
+    """64-битный difference hash: устойчив к пересжатию и ресайзу, который делает Telegram."""
+    gray = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)  # быстрый декод 1/4
+    if gray is None:
+        raise ValueError("Не удалось декодировать изображение")
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int("".join("1" if b else "0" for b in bits), 2)
+
+
+def rescale_detections(det: np.ndarray, from_shape: Tuple[int, int], to_shape: Tuple[int, int]) -> np.ndarray:
+    """Переносит рамки (n, 6) с картинки размера from_shape (h, w) на картинку размера to_shape."""
+    det = det.copy()
+    gy, gx = to_shape[0] / from_shape[0], to_shape[1] / from_shape[1]
+    det[:, [0, 2]] = (det[:, [0, 2]] * gx).clip(0, to_shape[1])
+    det[:, [1, 3]] = (det[:, [1, 3]] * gy).clip(0, to_shape[0])
+    det[:, :4] = det[:, :4].round()
+    return det